@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import socket
+import argparse
+import resource
+import subprocess
+from array import array
+from collect_metrics import collect_records, median
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Parameters of the generated inputs. The inputs in the working directory are reused, as long as these parameters are unchanged
+GENERATION_PARAMETERS = ["samples", "files_per_sample", "pipelines", "entries", "branches", "friends", "seed"]
+
+# Number of float branches of the ntuples in the friend files
+FRIEND_BRANCHES = 2
+
+STAGES = ["discovery", "merge", "check"]
+
+def sample_names(n):
+    return ["BenchmarkSample%d_13TeV" % i for i in range(n)]
+
+def pipeline_names(n):
+    return ["mt_nominal"] + ["mt_shift%d" % i for i in range(1, n)]
+
+def write_artus_file(path, pipelines, entries, branches, cutflow):
+    """ Write a file with the layout of an Artus ntuple: a directory per pipeline with the tree 'ntuple' with 'entries' entries of 'branches' float branches,
+    filled with random numbers, and the histogram 'cutFlowUnweighted' with the number of entries in its first bin, if 'cutflow' is set (not for friends)"""
+    import ROOT as R
+    F = R.TFile(path, "RECREATE")
+    for p in pipelines:
+        F.mkdir(p).cd()
+        tree = R.TTree("ntuple", "ntuple")
+        values = [array("f", [0.0]) for b in range(branches)]
+        for b, v in enumerate(values):
+            tree.Branch("var%d" % b, v, "var%d/F" % b)
+        for e in range(entries):
+            for v in values:
+                v[0] = R.gRandom.Gaus()
+            tree.Fill()
+        tree.Write()
+        if cutflow:
+            h = R.TH1D("cutFlowUnweighted", "cutFlowUnweighted", 2, 0, 2)
+            h.SetBinContent(1, entries)
+            h.Write()
+    F.Close()
+
+def generate_inputs(workdir, parameters):
+    """ Generate the synthetic inputs in the working directory: the Artus ntuples input/benchmark/<sample>/<sample>_job<i>.root,
+    one file per sample and friend friends/<friend>/<sample>/<sample>.root, datasets.json with the generated events of each sample,
+    and check_expectations.json with the expected number of pipelines. All ntuples are copies of a single generated file, all friends of another one"""
+    import ROOT as R
+    R.gROOT.SetBatch()
+    R.gRandom.SetSeed(parameters["seed"])
+    for d in ["input", "friends"]:
+        if os.path.exists(os.path.join(workdir, d)):
+            shutil.rmtree(os.path.join(workdir, d))
+    pipelines = pipeline_names(parameters["pipelines"])
+    ntuple_template = os.path.join(workdir, "ntuple_template.root")
+    friend_template = os.path.join(workdir, "friend_template.root")
+    write_artus_file(ntuple_template, pipelines, parameters["entries"], parameters["branches"], True)
+    write_artus_file(friend_template, pipelines, parameters["entries"] * parameters["files_per_sample"], FRIEND_BRANCHES, False)
+    datasets = {}
+    for sample in sample_names(parameters["samples"]):
+        sample_directory = os.path.join(workdir, "input", "benchmark", sample)
+        os.makedirs(sample_directory)
+        for i in range(parameters["files_per_sample"]):
+            shutil.copyfile(ntuple_template, os.path.join(sample_directory, "%s_job%d.root" % (sample, i)))
+        for friend in parameters["friends"]:
+            friend_directory = os.path.join(workdir, "friends", friend, sample)
+            os.makedirs(friend_directory)
+            shutil.copyfile(friend_template, os.path.join(friend_directory, sample + ".root"))
+        datasets[sample] = {"n_events_generated" : parameters["entries"] * parameters["files_per_sample"]}
+    os.remove(ntuple_template)
+    os.remove(friend_template)
+    json.dump(datasets, open(os.path.join(workdir, "datasets.json"), "w"), sort_keys=True, indent=2)
+    expectations = {"tolerance" : 0.0001, "n_pipelines_expected" : [{"pattern" : ".*", "n_pipelines" : parameters["pipelines"]}], "friend_exemptions" : []}
+    json.dump(expectations, open(os.path.join(workdir, "check_expectations.json"), "w"), sort_keys=True, indent=2)
+    json.dump(parameters, open(os.path.join(workdir, "generation.json"), "w"), sort_keys=True)
+
+def input_size(workdir):
+    """ Number and total size of the generated Artus ntuples"""
+    sizes = [os.path.getsize(os.path.join(d, f)) for d, subdirs, files in os.walk(os.path.join(workdir, "input")) for f in files]
+    return len(sizes), sum(sizes)
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run_stage(name, cmd, rundir):
+    """ Run a stage of the benchmark in the run directory with its output in <name>.log. Returns its wall time, the CPU time of all its processes and its exit code"""
+    print "Running %s stage, output in %s" % (name, os.path.join(rundir, name + ".log"))
+    sys.stdout.flush()
+    cpu = children_cpu_time()
+    start = time.time()
+    with open(os.path.join(rundir, name + ".log"), "w") as log:
+        exit_code = subprocess.call(cmd, cwd=rundir, stdout=log, stderr=subprocess.STDOUT)
+    result = {"wall" : time.time() - start, "cpu" : children_cpu_time() - cpu, "exit_code" : exit_code}
+    print "\t%s stage finished with exit code %d after %.1f s" % (name, exit_code, result["wall"])
+    return result
+
+def stage_commands(workdir, parameters):
+    """ Commands of the stages: planning of the merging jobs in local mode, running them locally and checking the merged files with their friends"""
+    python = sys.executable
+    expectations = os.path.join(workdir, "check_expectations.json")
+    discovery = [python, os.path.join(SCRIPTS_DIRECTORY, "merge_outputs.py"), "--sample-directories", "benchmark",
+                 "--main-input-directory", os.path.join(workdir, "input"), "--main-output-directory", os.path.join(workdir, "output"), "--target-directory", "merged",
+                 "--srm-server", "", "--dcap-server", "", "--xrootd-input-server", "", "--xrootd-output-server", "",
+                 "--resource-model", os.path.join(SCRIPTS_DIRECTORY, "..", "configs", "job_resources.json"), "--expectations", expectations]
+    merge = [python, os.path.join(SCRIPTS_DIRECTORY, "run_locally.py"), "--parallel", str(parameters["parallel"]), "--retries", "0"]
+    check = [python, os.path.join(SCRIPTS_DIRECTORY, "check_merged_files.py"), "--xrootd-server", "", "--input-directory", os.path.join(workdir, "output", "merged"),
+             "--database", os.path.join(workdir, "datasets.json"), "--expectations", expectations, "--results-cache", "", "--parallel", str(parameters["parallel"])]
+    if parameters["friends"]:
+        check += ["--input-friend-directories"] + [os.path.join(workdir, "friends", f) for f in parameters["friends"]]
+    return {
+        "discovery" : discovery + shlex.split(parameters["merge_options"]),
+        "merge" : merge,
+        "check" : check + shlex.split(parameters["check_options"]),
+    }
+
+def count_issues(rundir):
+    """ Number of issues found by the check, None if the check wrote no report"""
+    report = os.path.join(rundir, "check_issues.csv")
+    if not os.path.exists(report):
+        return None
+    return max(len(open(report, "r").read().strip().split("\n")) - 1, 0)
+
+def merge_job_summary(rundir):
+    """ Summary of the metrics written by the merging jobs, see scripts/collect_metrics.py"""
+    log_directory = os.path.join(rundir, "merging_logs")
+    if not os.path.isdir(log_directory):
+        return None
+    latest, attempts = collect_records([log_directory])
+    if not latest:
+        return None
+    return {
+        "jobs" : len(latest),
+        "failed" : sum(1 for r in latest.values() if r["exit_code"] != 0),
+        "median_job_throughput" : median([r["throughput"] for r in latest.values()]),
+        "peak_rss" : max(r["peak_rss"] for r in latest.values()),
+    }
+
+def git_commit():
+    """ Commit of the scripts, with '+dirty' for uncommitted changes. None outside of a git repository"""
+    try:
+        p = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPTS_DIRECTORY, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        commit = p.communicate()[0].strip()
+        if p.returncode != 0:
+            return None
+        p = subprocess.Popen(["git", "status", "--porcelain", "--untracked-files=no"], cwd=SCRIPTS_DIRECTORY, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return commit + ("+dirty" if p.communicate()[0].strip() else "")
+    except OSError:
+        return None
+
+def read_results(results_file):
+    if not os.path.exists(results_file):
+        return []
+    results = []
+    for line in open(results_file, "r"):
+        try:
+            results.append(json.loads(line))
+        except ValueError:
+            print "[WARNING] Ignoring corrupted line in",results_file
+    return results
+
+def print_history(results_file, parameters):
+    """ Print the recorded runs with the same parameters, with the change of the total time relative to the previous run"""
+    runs = [r for r in read_results(results_file) if r["parameters"] == parameters]
+    print "Benchmark runs with the same parameters in %s: %d" % (results_file, len(runs))
+    if not runs:
+        return
+    print "\t%-19s  %-14s  %9s  %9s  %9s  %9s  %8s  %7s  %s" % ("time", "commit", "discovery", "merge", "check", "total", "MB/s", "change", "label")
+    previous = None
+    for r in runs:
+        walls = ["%9.1f" % r["stages"][s]["wall"] if s in r["stages"] else "%9s" % "-" for s in STAGES]
+        change = "%+6.1f%%" % (100.0 * (r["total_wall"] / previous - 1.0)) if previous and r["success"] else "%7s" % "-"
+        throughput = "%8.1f" % r["merge_throughput"] if r["merge_throughput"] else "%8s" % "-"
+        print "\t%-19s  %-14s  %s  %9.1f  %s  %s  %s" % (r["time"], r["commit"], "  ".join(walls), r["total_wall"], throughput, change, r["label"] + ("" if r["success"] else " (failed)"))
+        if r["success"]:
+            previous = r["total_wall"]
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Benchmark of the merging and checking with synthetic Artus ntuples on the local machine. The inputs are generated with PyROOT in the working directory, the stages "discovery" (scripts/merge_outputs.py in local mode), "merge" (scripts/run_locally.py) and "check" (scripts/check_merged_files.py) are timed, and the results are appended to --results.')
+    parser.add_argument('--workdir',default='benchmark',help='Working directory for the generated inputs, the merged outputs and the files written by the stages. Default: %(default)s')
+    parser.add_argument('--samples',default=4,type=int,help='Number of generated samples. Default: %(default)s')
+    parser.add_argument('--files-per-sample',default=20,type=int,help='Number of Artus ntuples per sample. Default: %(default)s')
+    parser.add_argument('--pipelines',default=10,type=int,help='Number of pipeline directories in each ntuple. Default: %(default)s')
+    parser.add_argument('--entries',default=1000,type=int,help='Number of entries of the ntuple of each pipeline in each file. Default: %(default)s')
+    parser.add_argument('--branches',default=20,type=int,help='Number of float branches of the ntuples. Default: %(default)s')
+    parser.add_argument('--friends',default=['SVFit','MELA'],nargs='*',help='Names of the generated friends of each sample. Default: %(default)s')
+    parser.add_argument('--seed',default=1234,type=int,help='Seed of the random numbers filled into the ntuples. Default: %(default)s')
+    parser.add_argument('--parallel',default=4,type=int,help='Number of parallel merging jobs and of parallel processes of the check. Default: %(default)s')
+    parser.add_argument('--merge-options',default='',help='Further options of scripts/merge_outputs.py, e.g. --merge-options="--merge-mode tree --fan-in 5". Default: %(default)s')
+    parser.add_argument('--check-options',default='',help='Further options of scripts/check_merged_files.py, e.g. --check-options="--reader uproot". Default: %(default)s')
+    parser.add_argument('--regenerate',action='store_true',help='Generate the inputs again, even if inputs with the same parameters exist in the working directory.')
+    parser.add_argument('--results',default='benchmark_results.jsonl',help='File, to which the result of each run is appended as a line in .json format. Default: %(default)s')
+    parser.add_argument('--label',default='',help='Description of the run stored with its result, e.g. the tested change. Default: %(default)s')
+    parser.add_argument('--history',action='store_true',help='Only print the recorded runs with the same parameters.')
+    return parser.parse_args()
+
+def main():
+    args = parseargs()
+    parameters = dict((key, getattr(args, key)) for key in GENERATION_PARAMETERS + ["parallel", "merge_options", "check_options"])
+    if args.history:
+        print_history(args.results, parameters)
+        return
+    workdir = os.path.abspath(args.workdir)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    generation = dict((key, parameters[key]) for key in GENERATION_PARAMETERS)
+    generation_file = os.path.join(workdir, "generation.json")
+    if args.regenerate or not os.path.exists(generation_file) or json.load(open(generation_file, "r")) != generation:
+        print "Generating %d samples with %d files of %d pipelines in %s" % (args.samples, args.files_per_sample, args.pipelines, workdir)
+        start = time.time()
+        generate_inputs(workdir, generation)
+        print "\tGenerated after %.1f s" % (time.time() - start)
+    else:
+        print "Reusing the inputs generated in",workdir
+    n_files, n_bytes = input_size(workdir)
+
+    rundir = os.path.join(workdir, "run")
+    for d in [rundir, os.path.join(workdir, "output")]:
+        if os.path.exists(d):
+            shutil.rmtree(d)
+    os.makedirs(rundir)
+    commands = stage_commands(workdir, parameters)
+    stages = {}
+    for name in STAGES:
+        stages[name] = run_stage(name, commands[name], rundir)
+        if stages[name]["exit_code"] != 0:
+            print "[ERROR] %s stage failed, see %s" % (name, os.path.join(rundir, name + ".log"))
+            break
+    issues = count_issues(rundir)
+    result = {
+        "time" : time.strftime("%Y-%m-%d %H:%M:%S"),
+        "label" : args.label,
+        "commit" : git_commit(),
+        "host" : socket.getfqdn(),
+        "parameters" : parameters,
+        "input_files" : n_files,
+        "input_bytes" : n_bytes,
+        "stages" : stages,
+        "total_wall" : sum(s["wall"] for s in stages.values()),
+        "merge_throughput" : n_bytes / 1e6 / stages["merge"]["wall"] if "merge" in stages and stages["merge"]["wall"] > 0 else None,
+        "merge_jobs" : merge_job_summary(rundir),
+        "check_issues" : issues,
+        "success" : len(stages) == len(STAGES) and all(s["exit_code"] == 0 for s in stages.values()) and issues == 0,
+    }
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result, sort_keys=True) + "\n")
+    print "Input: %d files, %.2f GB. Total time: %.1f s, merge throughput: %s MB/s, issues found by the check: %s" % (
+        n_files, n_bytes / 1e9, result["total_wall"], "%.1f" % result["merge_throughput"] if result["merge_throughput"] else "-", "-" if issues is None else issues)
+    print_history(args.results, parameters)
+    if not result["success"]:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import json
+
+class Expectations(object):
+    """ Expectation rules for the checks of merged files: the expected number of pipelines per sample pattern, the tolerance of the
+    event count ratios and the exemptions from the friend check. The regular expressions are compiled once"""
+
+    def __init__(self, config):
+        self.tolerance = config["tolerance"]
+        self.pipeline_rules = [(re.compile(rule["pattern"]), rule["n_pipelines"]) for rule in config["n_pipelines_expected"]]
+        self.friend_exemptions = [dict((key, re.compile(rule[key])) for key in ["friend", "sample", "pipeline", "pipeline_not"] if key in rule) for rule in config["friend_exemptions"]]
+
+    def n_pipelines_expected(self, sample):
+        """ Expected number of pipelines from the first matching sample pattern, -1 if none matches"""
+        for pattern, n_pipelines in self.pipeline_rules:
+            if pattern.search(sample):
+                return n_pipelines
+        return -1
+
+def load_expectations(path):
+    return Expectations(json.load(open(path, "r")))
@@ -1,65 +1,115 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import ROOT as R
+from __future__ import print_function
+
 import json
 import os
 import re
-import glob
 from multiprocessing import Pool
-from XRootD import client
-from XRootD.client.flags import DirListFlags, OpenFlags, MkDirFlags, QueryCode, StatInfoFlags
 import argparse
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from storage_listing import StorageLister
+from root_readers import READERS, create_reader
+from check_expectations import load_expectations
+from check_validation import pipeline_table, friend_table, deviations, friend_exempted, write_reports
 
-def create_result_for_sample(info):
-    print "\tProcessing:",info["sample"]
-    result = {"sample" : info["sample"]}
-    F = R.TFile.Open(info["input_file"], "read")
-    if F.IsZombie() or F.TestBit(R.TFile.kRecovered):
-        F.Close()
-        return result
-    result["n_events_expected"] = info["database"].get(info["sample"],-1)["n_events_generated"]
-    result["ntuple_tree_events"] = {}
-    result["pipelines"] = sorted([k.GetName() for k in F.GetListOfKeys() if k.IsFolder()])
-    for pattern in info["n_pipelines_expected"]:
-        if re.search(pattern,info["sample"]):
-            result["n_pipelines_expected"] = info["n_pipelines_expected"][pattern]
-            break
-        else:
-            result["n_pipelines_expected"] = -1
+# Reader backend of the worker process, see root_readers.py
+worker_state = {}
+
+def init_worker(reader_name):
+    worker_state["reader"] = create_reader(reader_name)
+
+def read_unit(unit):
+    """ Read the file of a work unit: "ntuple" units read the merged file of a sample, "friend" units one of its friend files.
+    Errors are returned instead of raised, such that a single broken file does not stop the whole check"""
+    if unit["kind"] == "friend":
+        print("\tProcessing:",unit["sample"],"friend",unit["file"].split("/")[-3])
+    else:
+        print("\tProcessing:",unit["sample"])
+    try:
+        if unit["kind"] == "ntuple":
+            return unit, worker_state["reader"].read_ntuple_file(unit["file"]), None
+        return unit, worker_state["reader"].read_friend_file(unit["file"]), None
+    except Exception as e:
+        return unit, None, "%s: %s" % (type(e).__name__, e)
+
+def create_result_for_sample(sample, input_file, contents, database, expectations):
+    """ Combine the contents of the merged file and the friend files of a sample into its result. Returns None, if the merged file is broken"""
+    file_result = contents[input_file]
+    if not file_result:
+        return None
+    result = {}
+    result["n_events_expected"] = database.get(sample,-1)["n_events_generated"]
+    result["ntuple_tree_events"] = dict(file_result["ntuple_tree_events"])
+    result["pipelines"] = list(file_result["pipelines"])
+    result["n_pipelines_expected"] = expectations.n_pipelines_expected(sample)
     for p in result["pipelines"]:
-        cutflow = F.Get(p).Get("cutFlowUnweighted")
-        ntuple = F.Get(p).Get("ntuple")
-        if cutflow:
-            result[p] = cutflow.GetBinContent(1) 
-            cutflow.Delete()
-        else:
-            result[p] = 0
-        if ntuple:
-            result["ntuple_tree_events"][p] = ntuple.GetEntries()
-            ntuple.Delete()
-        else:
-            result["ntuple_tree_events"][p] = 0
-    F.Close()
+        result[p] = file_result["cutflow"][p]
     result["friends"] = {}
-    for friend in info["input_friends"]:
+    for friend, friend_result in [(f, c) for f, c in contents.items() if f != input_file]:
         friendtype = friend.split("/")[-3]
-        result["friends"][friendtype] = {}
-        friendF = R.TFile.Open(friend,"read")
-        for p in result["pipelines"]:
-            d = friendF.Get(p)
-            if d:
-                ntuple = d.Get("ntuple")
-                if ntuple:
-                    result["friends"][friendtype][p] = ntuple.GetEntries()
-                else:
-                    result["friends"][friendtype][p] = 0
-                ntuple.Delete()
-            else:
-                result["friends"][friendtype][p] = 0
-        friendF.Close()
+        result["friends"][friendtype] = dict((p, friend_result.get(p, 0)) for p in result["pipelines"])
     return result
 
+def read_sidecar(path):
+    """ Read a metadata sidecar <sample>.check.json written by the merging job, locally or via xrootd. Returns None, if not readable"""
+    try:
+        if "://" in path:
+            from XRootD import client
+            with client.File() as f:
+                status, response = f.open(path)
+                if not status.ok:
+                    return None
+                status, data = f.read()
+                if not status.ok:
+                    return None
+        else:
+            data = open(path, "r").read()
+        return json.loads(data)
+    except (IOError, ValueError):
+        return None
+
+def sidecar_matches(sidecar, input_file, stat, sidecar_mtime):
+    """ A sidecar is used for a merged file, if it was written for a file with the same name and size, and the file was not modified after the sidecar was written"""
+    size, mtime = stat
+    return sidecar is not None and sidecar.get("file") == os.path.basename(input_file) and sidecar.get("size") == size and mtime <= sidecar_mtime
+
+def record_result(stream, sample, result):
+    stream.write(json.dumps({"sample" : sample, "result" : result}, sort_keys=True) + "\n")
+    stream.flush()
+
+def load_results_cache(cache_file):
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    try:
+        return json.load(open(cache_file, "r"))
+    except ValueError:
+        print("[WARNING] Ignoring corrupted results cache",cache_file)
+        return {}
+
+def save_results_cache(cache_file, cache, file_stats):
+    """ Store the results cache. Entries of files, which are no longer found in the checked directories, are evicted"""
+    if not cache_file:
+        return
+    directories = set(os.path.dirname(f) for f in file_stats)
+    for f in [f for f in cache if f not in file_stats and os.path.dirname(f) in directories]:
+        cache.pop(f)
+    json.dump(cache, open(cache_file, "w"))
+
+def read_results_stream(stream_file):
+    """ Results of the samples recorded in the stream file. Incomplete lines, e.g. from an interrupted check, are ignored"""
+    results = {}
+    if not os.path.exists(stream_file):
+        return results
+    for line in open(stream_file, "r"):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        results[record["sample"]] = record["result"]
+    return results
 
 def sorted_nicely(l):
     """ Sort the given iterable in the way that humans expect: alphanumeric sort (in bash, that's 'sort -V')"""
@@ -76,32 +126,40 @@ def parseargs():
     parser = argparse.ArgumentParser(description='Small script to check merged artus ntuples from local or xrootd resources using miltiprocessing.')
     parser.add_argument('--xrootd-server',default='root://cmsxrootd-kit.gridka.de/',type=nullable_string,help='xrootd server to access your merged files and to create the output directory. Only used in xrootd mode. Default: %(default)s')
     parser.add_argument('--input-directory',default='/pnfs/gridka.de/cms/disk-only/store/user/store/aakhmets/test/',help='input directory path for merged artus ntuples on the machine or server. Default: %(default)s')
+    parser.add_argument('--friend-xrootd-server',default='',type=nullable_string,help='xrootd server to access the friend files. The friend directories are accessed locally, if empty. Default: %(default)s')
     parser.add_argument('--input-friend-directories',default=[],nargs='+',help='input directory paths for friends of merged artus ntuples on the machine or server. Default: %(default)s')
     parser.add_argument('--database',default='datasets/datasets.json',help='File in .json format with datasets info. Default: %(default)s')
     parser.add_argument('--match-to-sample-regex',default='.*',help='Regular expression to restrict the samples to be checked to. Default: %(default)s')
     parser.add_argument('--results',default=None,help='Already computed results to be examined. Default: %(default)s')
-    parser.add_argument('--parallel',default=5,type=int,help='Number of cores to be used to process the ROOT files. Default: %(default)s')
+    parser.add_argument('--results-cache',default='check_cache.json',type=nullable_string,help='File to cache the contents read from the merged and friend files, together with their size and modification time. Only new or modified files are opened again. Disabled for an empty string. Default: %(default)s')
+    parser.add_argument('--results-stream',default='check_results.jsonl',help='File, to which the result of each sample is appended as soon as its merged file and all its friends are read. Default: %(default)s')
+    parser.add_argument('--resume',action='store_true',help='Continue an interrupted check: samples already recorded in --results-stream are not checked again.')
+    parser.add_argument('--parallel',default=5,type=int,help='Number of cores to be used to process the ROOT files. Each merged file and each friend file is processed as a separate work unit. Default: %(default)s')
+    parser.add_argument('--sidecars',action='store_true',help='Use the metadata sidecars <sample>.check.json written by the merging jobs next to the merged files instead of reading the merged files. Merged files without matching sidecar are read as usual.')
+    parser.add_argument('--reader',default='pyroot',choices=sorted(READERS.keys()),help='Backend to read the merged and friend files: "pyroot" or "uproot", which does not need ROOT. Default: %(default)s')
+    parser.add_argument('--listing-threads',default=10,type=int,help='Number of directories listed concurrently. Default: %(default)s')
+    parser.add_argument('--listing-cache',default='listing_cache.json',help='File to cache the directory listings. Default: %(default)s')
+    parser.add_argument('--listing-cache-ttl',default=0,type=float,help='Time in seconds, for which cached directory listings are reused. Disabled for values <= 0. Default: %(default)s')
+    parser.add_argument('--expectations',default='configs/check_expectations.json',help='File in .json format with the expected numbers of pipelines per sample pattern, the tolerance of the event count ratios and the exemptions from the friend check. Default: %(default)s')
+    parser.add_argument('--report-formats',default=['csv'],nargs='*',choices=['csv','parquet'],help='Formats of the machine-readable report check_issues.<format> of all found issues, written in addition to the .txt files. Parquet needs pandas. Default: %(default)s')
     parser.add_argument('--check-modes',default=["file","pipelines","entryhist","friends"],nargs='+',choices=["file","pipelines","entryhist","entrytree","friends"],help='Specification of checks to be done. Default: %(default)s')
 
     return parser.parse_args()
 
 def main():
     args = parseargs()
+    expectations = load_expectations(args.expectations)
     if args.results:
         dataset_results = json.load(open(args.results,'r'))
     else:
-        R.gROOT.SetBatch()
-        R.gErrorIgnoreLevel = R.kError
-        if args.parallel > 1:
-            p = Pool(args.parallel)
-
         xrootd_server = args.xrootd_server.strip("/") if args.xrootd_server else None
         input_modes = {
             "local" : not xrootd_server,
             "xrootd" : xrootd_server,
         }
-        if input_modes["xrootd"]:
-            xrootdclient = client.FileSystem(xrootd_server)
+        lister = StorageLister(xrootd_server, args.listing_threads, args.listing_cache, args.listing_cache_ttl)
+        friend_xrootd_server = args.friend_xrootd_server.strip("/") if args.friend_xrootd_server else None
+        friend_lister = StorageLister(friend_xrootd_server, args.listing_threads, args.listing_cache, args.listing_cache_ttl)
         input_directory = args.input_directory.strip("/")
         friend_directories = [d.strip("/") for d in args.input_friend_directories]
         sample_pattern = args.match_to_sample_regex
@@ -109,144 +167,226 @@ def main():
 
         dataset_dict = {}
         friend_dict = {}
+        sidecar_files = {}
+        sidecar_mtimes = {}
         file_dict = {}
-        dataset_infos = [] 
+        file_stats = {}
+        results_cache = load_results_cache(args.results_cache)
         dataset_results = {}
+        if args.resume:
+            dataset_results = read_results_stream(args.results_stream)
+            print("Samples already checked in %s: %d" % (args.results_stream, len(dataset_results)))
+        elif os.path.exists(args.results_stream):
+            os.remove(args.results_stream)
 
-        ### ATTENTION!!! The following dict is hardcoded and needs continious updates!!! Current status:
-        # mt.py:  needed_pipelines = ['nominal', 'tauESperDM_shifts', 'tauMuFakeESperDM_shifts', 'regionalJECunc_shifts', 'METunc_shifts', 'METrecoil_shifts', 'btagging_shifts']
-        # et.py:  needed_pipelines = ['nominal', 'tauESperDM_shifts', 'tauEleFakeESperDM_shifts', 'regionalJECunc_shifts', 'METunc_shifts', 'METrecoil_shifts', 'btagging_shifts', 'eleES_shifts']
-        # tt.py:  needed_pipelines = ['nominal', 'tauESperDM_shifts', 'regionalJECunc_shifts', 'METunc_shifts', 'METrecoil_shifts', 'btagging_shifts']
-        # em.py:  needed_pipelines = ['nominal', 'eleES_shifts', 'regionalJECunc_shifts', 'METunc_shifts', 'METrecoil_shifts', 'btagging_shifts']
-
-        n_pipelines_expected  = {
-            "(SingleMuon|SingleElectron|EGamma|MuonEG).*Run201" : 1, # corresponding channel in data
-            "Tau.*Run201" : 3,                                       # mt, et, tt in data
-            "(Mu|Tau)TauFinalState" : 9,                             # mt/tt + 8 Tau ES in embedding
-            "ElTauFinalState" : 11,                                  # et + 8 Tau ES + 2 Ele ES in embedding
-            "ElMuFinalState" : 3,                                    # em + 2 Ele ES in embedding
-            "DY.?Jets|EWKZ" : 184,                                   # bosonic MC w/o Z (next below) + 8 Ele->Tau ES + 4 Mu->Tau ES in Z boson MC
-            "ttHJet|HTo(WW|TauTau)|W.?Jets|WG|EWKW" : 172,           # non-bosonic MC (next below) + 4 * 4 MET recoil in bosonic MC w/o Z
-            "ST.*top.*|TTTo|TT_|WW_|ZZ_|WZ_|WWTo|ZZTo|WZTo|VVTo" : 156,                  # 4 channels + 3 * 8 Tau ES + 2 * 4 Ele ES + 4 * 4 btagging + 4 * 2 MET unclustered + 4 * 24 Jet ES/ER
-        }
-
-        print "Gathering infos from ROOT files"
+        print("Gathering infos from ROOT files")
         if input_modes["xrootd"]:
-            status, listing = xrootdclient.dirlist(input_directory, DirListFlags.STAT)
-            print "Investigating via xrdfs:",os.path.join("/",input_directory)
-            sample_dirs = [ entry.name.strip("/") for entry in listing if (entry.statinfo.flags & StatInfoFlags.IS_DIR) and re.search(sample_pattern,entry.name)]
-        elif input_modes["local"]:
-            sample_dirs = [os.path.basename(name).strip("/") for name in glob.glob(os.path.join("/",input_directory,"*")) if os.path.isdir(name) and re.search(sample_pattern,name)]
+            print("Investigating via xrdfs:",os.path.join("/",input_directory))
+        listing = lister.list_directories([input_directory])[input_directory]
+        if listing is None:
+            print("[ERROR] Could not list input directory %s. Aborting..." % input_directory)
+            exit(1)
+        sample_dirs = [ entry["name"] for entry in listing if entry["is_dir"] and re.search(sample_pattern,entry["name"])]
 
+        sample_listings = lister.list_directories([os.path.join(input_directory,sd) for sd in sample_dirs])
+        if friend_xrootd_server:
+            print("Investigating friends via xrdfs:"," ".join([os.path.join("/",f) for f in friend_directories]))
+        friend_listings = friend_lister.list_directories([os.path.join(f,sd) for f in friend_directories for sd in sample_dirs])
         for sd in sample_dirs:
             input_friends = []
             sample_dir = os.path.join(input_directory,sd)
-            if input_modes["xrootd"]:
-                s, dataset_listing = xrootdclient.dirlist(sample_dir, DirListFlags.STAT)
-                input_files = [os.path.join(xrootd_server,sample_dir,entry.name) for entry in dataset_listing if ".root" in entry.name]
-            elif input_modes["local"]:
-                input_files = glob.glob(os.path.join("/",sample_dir,"*.root"))
+            input_files = []
+            if sample_listings[sample_dir] is None:
+                print("[ERROR] Could not list sample directory %s. Aborting..." % sample_dir)
+                exit(1)
+            for entry in sample_listings[sample_dir]:
+                if entry["name"].endswith(".root") and not entry["is_dir"]:
+                    if input_modes["xrootd"]:
+                        input_files.append(os.path.join(xrootd_server,sample_dir,entry["name"]))
+                    elif input_modes["local"]:
+                        input_files.append(os.path.join("/",sample_dir,entry["name"]))
+                    file_stats[input_files[-1]] = [entry["size"], entry["mtime"]]
+                elif entry["name"] == sd + ".check.json" and not entry["is_dir"]:
+                    if input_modes["xrootd"]:
+                        sidecar_files[sd] = os.path.join(xrootd_server,sample_dir,entry["name"])
+                    elif input_modes["local"]:
+                        sidecar_files[sd] = os.path.join("/",sample_dir,entry["name"])
+                    sidecar_mtimes[sd] = entry["mtime"]
             for f in friend_directories:
-                input_friends += glob.glob(os.path.join("/",f,sd,"*.root"))
+                friend_listing = friend_listings[os.path.join(f,sd)]
+                if friend_listing is None and friend_xrootd_server:
+                    print("[ERROR] Could not list friend directory %s. Aborting..." % os.path.join(f,sd))
+                    exit(1)
+                for entry in friend_listing or []:
+                    if entry["name"].endswith(".root") and not entry["is_dir"]:
+                        if friend_xrootd_server:
+                            input_friends.append(os.path.join(friend_xrootd_server,f,sd,entry["name"]))
+                        else:
+                            input_friends.append(os.path.join("/",f,sd,entry["name"]))
+                        file_stats[input_friends[-1]] = [entry["size"], entry["mtime"]]
             dataset_dict.setdefault(sd, [])
             dataset_dict[sd] += input_files
 
             friend_dict.setdefault(sd, [])
             friend_dict[sd] += input_friends
 
+        # Each merged file and each friend file is a separate work unit. A sample is finished, when all its units are read
+        units = []
+        samples = {}
+        n_cached = 0
+        n_sidecars = 0
+        sidecars = {}
+        if args.sidecars and sidecar_files:
+            pool = ThreadPool(min(args.listing_threads, len(sidecar_files)))
+            sidecars = dict(zip(sidecar_files.keys(), pool.map(read_sidecar, sidecar_files.values())))
+            pool.close()
+            pool.join()
         for sd in sorted_nicely(dataset_dict.keys()):
-            if len(dataset_dict[sd]) != 1:
+            if sd in dataset_results:
+                continue
+            elif len(dataset_dict[sd]) != 1:
                 dataset_results[sd] = None
             else:
-                dataset_infos.append({"sample" : sd, "database" : database, "n_pipelines_expected" : n_pipelines_expected, "input_file" : dataset_dict[sd][0], "input_friends" : friend_dict[sd]})
+                samples[sd] = {"input_file" : dataset_dict[sd][0], "contents" : {}, "units_left" : 0, "errors" : []}
+                for f in dataset_dict[sd] + friend_dict[sd]:
+                    if f in results_cache and results_cache[f]["stat"] == file_stats[f]:
+                        samples[sd]["contents"][f] = results_cache[f]["content"]
+                        n_cached += 1
+                    elif f == dataset_dict[sd][0] and sidecar_matches(sidecars.get(sd), f, file_stats[f], sidecar_mtimes.get(sd)):
+                        samples[sd]["contents"][f] = sidecars[sd]
+                        n_sidecars += 1
+                    else:
+                        units.append({"sample" : sd, "kind" : "ntuple" if f == dataset_dict[sd][0] else "friend", "file" : f})
+                        samples[sd]["units_left"] += 1
+        print("Files to be read: %d, taken from the results cache: %d, from sidecars: %d" % (len(units), n_cached, n_sidecars))
+        # Largest files first, such that the large files don't end up last in the queue
+        units.sort(key=lambda u: file_stats[u["file"]][0], reverse=True)
 
         if args.parallel > 1:
-            results_list = p.map(create_result_for_sample, dataset_infos)
+            p = Pool(args.parallel, init_worker, (args.reader,))
+            results_iterator = p.imap_unordered(read_unit, units)
         else:
-            results_list = []
-            for info in dataset_infos:
-                results_list.append(create_result_for_sample(info))
-        for r in results_list:
-            s = r.pop("sample")
-            if r != {}:
-                dataset_results[s] = r
+            init_worker(args.reader)
+            results_iterator = (read_unit(u) for u in units)
+        # An interrupted check may have left an incomplete last line
+        incomplete = False
+        if os.path.exists(args.results_stream) and os.path.getsize(args.results_stream) > 0:
+            with open(args.results_stream, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                incomplete = f.read(1) != b"\n"
+        stream = open(args.results_stream, "a")
+        if incomplete:
+            stream.write("\n")
+        for sd in [sd for sd in sorted_nicely(samples.keys()) if samples[sd]["units_left"] == 0]:
+            dataset_results[sd] = create_result_for_sample(sd, samples[sd]["input_file"], samples[sd]["contents"], database, expectations)
+            record_result(stream, sd, dataset_results[sd])
+        n_errors = 0
+        for unit, content, error in results_iterator:
+            sd = unit["sample"]
+            samples[sd]["units_left"] -= 1
+            if error:
+                samples[sd]["errors"].append("%s: %s" % (unit["file"], error))
+            else:
+                samples[sd]["contents"][unit["file"]] = content
+                results_cache[unit["file"]] = {"stat" : file_stats[unit["file"]], "content" : content}
+            if samples[sd]["units_left"] > 0:
+                continue
+            if samples[sd]["errors"]:
+                print("[ERROR] Checking of sample %s failed: %s" % (sd, "; ".join(samples[sd]["errors"])))
+                dataset_results[sd] = None
+                n_errors += 1
             else:
-                dataset_results[s] = None
+                dataset_results[sd] = create_result_for_sample(sd, samples[sd]["input_file"], samples[sd]["contents"], database, expectations)
+                record_result(stream, sd, dataset_results[sd])
+        stream.close()
+        if args.parallel > 1:
+            p.close()
+            p.join()
+        if n_errors:
+            print("[WARNING] Checking failed for %d samples, which are not recorded in %s and are checked again with --resume" % (n_errors, args.results_stream))
 
-        print "Dumping results into a .json file"
+        save_results_cache(args.results_cache, results_cache, file_stats)
+        print("Dumping results into a .json file")
         json.dump(dataset_results,open("check_results.json","w"),sort_keys=True,indent=2)
 
     # Examining the results:
+    tolerance = expectations.tolerance
+    issues = []
     no_files_list = []
     incorrect_pipelines_list = []
     incorrect_nevents_dict = {}
     incorrect_nevents_from_tree_dict = {}
     incorrect_friends_dict = {}
     if "file" in args.check_modes:
-        print "1. step: examining availability of the merged files."
+        print("1. step: examining availability of the merged files.")
         for s in sorted_nicely(dataset_results.keys()):
             if not dataset_results[s]:
-                print "\tNo correct or too many files found for sample:",s
+                print("\tNo correct or too many files found for sample:",s)
                 dataset_results.pop(s)
                 no_files_list.append(s)
+                issues.append({"check" : "file", "sample" : s})
     else:
-        print "SKIPPING 1. step: examining availability of the merged files."
+        print("SKIPPING 1. step: examining availability of the merged files.")
     if "pipelines" in args.check_modes:
-        print "2. step: examining number of pipelines in the merged files."
-        for s in sorted_nicely(dataset_results.keys()):
-            exp = dataset_results[s]["n_pipelines_expected"]
-            found = len(dataset_results[s]["pipelines"])
-            if exp != found:
-                print "\tIncorrect number of pipelines for sample:",s,"exp =",exp,"found =",found
-                dataset_results.pop(s)
-                incorrect_pipelines_list.append(s)
+        print("2. step: examining number of pipelines in the merged files.")
+        checked_samples = sorted_nicely(dataset_results.keys())
+        expected = np.array([expectations.n_pipelines_expected(s) for s in checked_samples], dtype=int)
+        found = np.array([len(dataset_results[s]["pipelines"]) for s in checked_samples], dtype=int)
+        for i in np.flatnonzero(expected != found):
+            s = checked_samples[i]
+            print("\tIncorrect number of pipelines for sample:",s,"exp =",expected[i],"found =",found[i])
+            dataset_results.pop(s)
+            incorrect_pipelines_list.append(s)
+            issues.append({"check" : "pipelines", "sample" : s, "expected" : int(expected[i]), "found" : int(found[i])})
     else:
-        print "SKIPPING 2. step: examining number of pipelines in the merged files."
+        print("SKIPPING 2. step: examining number of pipelines in the merged files.")
+    checked_samples = sorted_nicely(dataset_results.keys())
+    if "entryhist" in args.check_modes or "entrytree" in args.check_modes:
+        pipelines = pipeline_table(dataset_results, checked_samples)
     if "entryhist" in args.check_modes:
-        print "3. step: examining number of events for each pipeline in the merged files from cutflow histograms. Deviations > 0.0001 considered as incorrect."
-        for s in sorted_nicely(dataset_results.keys()):
-            exp = float(dataset_results[s]["n_events_expected"])
-            for p in dataset_results[s]["pipelines"]:
-                found = dataset_results[s][p]
-                if abs(found/exp - 1.0)  > 0.0001:
-                    print "\tExamining sample:",s
-                    print "\t\tIncorrect number of events for pipeline:",p,"exp =",exp,"found =",found,"ratio to exp =",found/exp
-                    incorrect_nevents_dict.setdefault(s,[])
-                    incorrect_nevents_dict[s].append(p)
+        print("3. step: examining number of events for each pipeline in the merged files from cutflow histograms. Deviations > %s considered as incorrect." % tolerance)
+        ratio, incorrect = deviations(pipelines["cutflow"], pipelines["n_events_expected"], tolerance)
+        for i in np.flatnonzero(incorrect):
+            s, p, exp, found = pipelines["sample"][i], pipelines["pipeline"][i], float(pipelines["n_events_expected"][i]), pipelines["cutflow"][i]
+            print("\tExamining sample:",s)
+            print("\t\tIncorrect number of events for pipeline:",p,"exp =",exp,"found =",found,"ratio to exp =",float(ratio[i]))
+            incorrect_nevents_dict.setdefault(s,[])
+            incorrect_nevents_dict[s].append(p)
+            issues.append({"check" : "entryhist", "sample" : s, "pipeline" : p, "expected" : exp, "found" : found, "ratio" : float(ratio[i])})
     else:
-        print "SKIPPING 3. step: examining number of events for each pipeline in the merged files from cutflow histograms."
+        print("SKIPPING 3. step: examining number of events for each pipeline in the merged files from cutflow histograms.")
     if "friends" in args.check_modes:
-        print "4. step: examining number of events for each pipeline in the friend files. Deviations > 0.0001 considered as incorrect."
-        for s in sorted_nicely(dataset_results.keys()):
-            for p in dataset_results[s]["pipelines"]:
-                exp = dataset_results[s]["ntuple_tree_events"][p]
-                for friend in dataset_results[s]["friends"]:
-                    found = dataset_results[s]["friends"][friend][p]
-                    if abs(found/exp - 1.0)  > 0.0001:
-                        if not (friend == "FakeFactors" and (("t_nominal" not in p and "tauEs" not in p) or "MuonEG" in s)):
-                            print "\tExamining sample:",s
-                            print "\t\tExamining pipeline:",p
-                            print "\t\t\t\tIncorrect number of events for friend:",friend,"exp =",exp,"found =",found,"ratio to exp =",found/exp
-                            incorrect_friends_dict.setdefault(s,{})
-                            incorrect_friends_dict[s].setdefault(p,[])
-                            incorrect_friends_dict[s][p].append(friend)
+        print("4. step: examining number of events for each pipeline in the friend files. Deviations > %s considered as incorrect." % tolerance)
+        friends = friend_table(dataset_results, checked_samples)
+        ratio, incorrect = deviations(friends["friend_events"], friends["ntuple_tree_events"], tolerance)
+        incorrect &= ~friend_exempted(expectations, friends["sample"], friends["pipeline"], friends["friend"])
+        for i in np.flatnonzero(incorrect):
+            s, p, friend, exp, found = friends["sample"][i], friends["pipeline"][i], friends["friend"][i], friends["ntuple_tree_events"][i], friends["friend_events"][i]
+            print("\tExamining sample:",s)
+            print("\t\tExamining pipeline:",p)
+            print("\t\t\t\tIncorrect number of events for friend:",friend,"exp =",exp,"found =",found,"ratio to exp =",float(ratio[i]))
+            incorrect_friends_dict.setdefault(s,{})
+            incorrect_friends_dict[s].setdefault(p,[])
+            incorrect_friends_dict[s][p].append(friend)
+            issues.append({"check" : "friends", "sample" : s, "pipeline" : p, "friend" : friend, "expected" : exp, "found" : found, "ratio" : float(ratio[i])})
     else:
-        print "SKIPPING 4. step: examining number of events for each pipeline in the friend files."
+        print("SKIPPING 4. step: examining number of events for each pipeline in the friend files.")
     if "entrytree" in args.check_modes:
-        print "3A. step: examining number of events for each pipeline in the merged files directly from tree, asuming, no selection was applied. Deviations > 0.0001 considered as incorrect."
-        for s in sorted_nicely(dataset_results.keys()):
-            exp = float(dataset_results[s]["n_events_expected"])
-            for p in dataset_results[s]["pipelines"]:
-                found = dataset_results[s]["ntuple_tree_events"][p]
-                if abs(found/exp - 1.0)  > 0.0001:
-                    print "\tExamining sample:",s
-                    print "\t\tIncorrect number of events for pipeline:",p,"exp =",exp,"found =",found,"ratio to exp =",found/exp
-                    incorrect_nevents_from_tree_dict.setdefault(s,[])
-                    incorrect_nevents_from_tree_dict[s].append(p)
+        print("3A. step: examining number of events for each pipeline in the merged files directly from tree, asuming, no selection was applied. Deviations > %s considered as incorrect." % tolerance)
+        ratio, incorrect = deviations(pipelines["ntuple_tree_events"], pipelines["n_events_expected"], tolerance)
+        for i in np.flatnonzero(incorrect):
+            s, p, exp, found = pipelines["sample"][i], pipelines["pipeline"][i], float(pipelines["n_events_expected"][i]), pipelines["ntuple_tree_events"][i]
+            print("\tExamining sample:",s)
+            print("\t\tIncorrect number of events for pipeline:",p,"exp =",exp,"found =",found,"ratio to exp =",float(ratio[i]))
+            incorrect_nevents_from_tree_dict.setdefault(s,[])
+            incorrect_nevents_from_tree_dict[s].append(p)
+            issues.append({"check" : "entrytree", "sample" : s, "pipeline" : p, "expected" : exp, "found" : found, "ratio" : float(ratio[i])})
     else:
-        print "SKIPPING 3A. step: examining number of events for each pipeline in the merged files directly from tree, asuming, no selection was applied."
+        print("SKIPPING 3A. step: examining number of events for each pipeline in the merged files directly from tree, asuming, no selection was applied.")
 
     # Saving the examination:
+    write_reports(issues, args.report_formats)
+
     if "file" in args.check_modes:
         no_files = open("no_files.txt","w")
         no_files.write("\n".join(no_files_list))
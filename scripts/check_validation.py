@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import csv
+import numpy as np
+
+def friend_exempted(expectations, samples, pipelines, friends):
+    """ Mask of the friend entries exempted from the check by the expectations. A rule applies, if all of its patterns match ("pipeline_not": does not match)"""
+    mask = np.zeros(len(samples), dtype=bool)
+    for rule in expectations.friend_exemptions:
+        rule_mask = np.ones(len(samples), dtype=bool)
+        for key, column in [("friend", friends), ("sample", samples), ("pipeline", pipelines), ("pipeline_not", pipelines)]:
+            if key in rule:
+                rule_mask &= match_column(rule[key], column) != (key == "pipeline_not")
+        mask |= rule_mask
+    return mask
+
+def match_column(pattern, column):
+    """ Mask of the entries of a column matching the pattern. The pattern is evaluated once per distinct value"""
+    if len(column) == 0:
+        return np.zeros(0, dtype=bool)
+    values, inverse = np.unique(np.array(column, dtype=object).astype(str), return_inverse=True)
+    return np.array([bool(pattern.search(v)) for v in values], dtype=bool)[inverse]
+
+def deviations(found, expected, tolerance):
+    """ Ratios of the found to the expected numbers and the mask of ratios deviating from 1 by more than the tolerance.
+    0 found for 0 expected counts as correct"""
+    found = np.asarray(found, dtype=float)
+    expected = np.asarray(expected, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = found / expected
+    ratio[(found == 0) & (expected == 0)] = 1.0
+    return ratio, np.abs(ratio - 1.0) > tolerance
+
+def pipeline_table(dataset_results, samples):
+    """ Columns with one entry per pipeline of the given samples: sample, pipeline, expected events, events from the cutflow and the ntuple"""
+    rows = [(s, p, dataset_results[s]["n_events_expected"], dataset_results[s][p], dataset_results[s]["ntuple_tree_events"][p]) for s in samples for p in dataset_results[s]["pipelines"]]
+    return dict((name, [r[i] for r in rows]) for i, name in enumerate(["sample", "pipeline", "n_events_expected", "cutflow", "ntuple_tree_events"]))
+
+def friend_table(dataset_results, samples):
+    """ Columns with one entry per pipeline and friend of the given samples: sample, pipeline, friend, ntuple events in the merged and in the friend file"""
+    rows = [(s, p, friend, dataset_results[s]["ntuple_tree_events"][p], dataset_results[s]["friends"][friend][p]) for s in samples for p in dataset_results[s]["pipelines"] for friend in dataset_results[s]["friends"]]
+    return dict((name, [r[i] for r in rows]) for i, name in enumerate(["sample", "pipeline", "friend", "ntuple_tree_events", "friend_events"]))
+
+REPORT_COLUMNS = ["check", "sample", "pipeline", "friend", "expected", "found", "ratio"]
+
+def write_reports(issues, formats, basename="check_issues"):
+    """ Write the found issues as table with the columns REPORT_COLUMNS into <basename>.csv and/or <basename>.parquet.
+    Parquet needs pandas with pyarrow or fastparquet"""
+    if "csv" in formats:
+        with open(basename + ".csv", "w") as f:
+            writer = csv.DictWriter(f, REPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(issues)
+    if "parquet" in formats:
+        try:
+            import pandas as pd
+            pd.DataFrame(issues, columns=REPORT_COLUMNS).to_parquet(basename + ".parquet", index=False)
+        except ImportError as e:
+            print("[WARNING] Parquet report not written: %s" % e)
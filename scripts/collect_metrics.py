@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+import json
+import argparse
+
+# Tag of the line with the metrics in the output of scripts/merge_job.py, see JobMetrics there
+METRICS_TAG = "[METRICS] "
+
+# Upper edges in GB of the input size classes of the merge steps in the step report
+STEP_SIZE_CLASSES = [0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0]
+
+def read_metrics_file(path):
+    """ Metrics of the jobs in a file: a .json file written with --metrics-file, or the output of jobs with lines starting with METRICS_TAG"""
+    if path.endswith(".json"):
+        try:
+            return [json.load(open(path, "r"))]
+        except ValueError:
+            print "[WARNING] Ignoring corrupted metrics file",path
+            return []
+    records = []
+    for line in open(path, "r"):
+        if line.startswith(METRICS_TAG):
+            try:
+                records.append(json.loads(line[len(METRICS_TAG):]))
+            except ValueError:
+                print "[WARNING] Ignoring corrupted metrics line in",path
+    return records
+
+def record_key(record):
+    """ Jobs are identified by the id of their plan and their name, since the names are reused by later plans. Records without plan id are from older bundles"""
+    return (record.get("plan") or "", record["job"])
+
+def collect_records(paths):
+    """ Metrics of all jobs found in the given files and directories. Directories are searched for .metrics.json files and for the
+    job outputs (.out from condor, .log from scripts/run_locally.py). Returns the latest attempt of each job and the number of attempts, keyed by record_key"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith((".metrics.json", ".out", ".log"))]
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            print "[WARNING] Metrics path %s does not exist" % path
+    attempts = {}
+    for f in files:
+        for record in read_metrics_file(f):
+            attempts.setdefault(record_key(record), {})[record["start"]] = record
+    latest = dict((job, runs[max(runs)]) for job, runs in attempts.items())
+    return latest, dict((job, len(runs)) for job, runs in attempts.items())
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    n = len(values)
+    return values[n / 2] if n % 2 else 0.5 * (values[n / 2 - 1] + values[n / 2])
+
+def ratio(numerator, denominator):
+    return numerator / float(denominator) if denominator else None
+
+def sample_report(records):
+    """ One row per sample: the input size, the summed wall and CPU time of its units, the merge throughput and the stage-out time.
+    Reductions of partial merges add their time, but not their inputs, which were already counted by the partial merges"""
+    samples = {}
+    for record in records:
+        for unit in record["units"]:
+            row = samples.setdefault(unit["sample"], {"sample" : unit["sample"], "units" : 0, "input_gb" : 0.0, "wall" : 0.0, "cpu" : 0.0,
+                                                      "transfer_wall" : 0.0, "transfer_gb" : 0.0, "peak_rss" : 0.0, "sites" : set()})
+            row["units"] += 1
+            if unit["kind"] != "reduction":
+                row["input_gb"] += unit["input_bytes"] / 1e9
+            row["wall"] += unit["wall"]
+            row["cpu"] += sum(step["cpu"] for step in unit["steps"])
+            row["transfer_wall"] += sum(t["wall"] for t in unit["transfers"])
+            row["transfer_gb"] += sum(t["bytes"] or 0 for t in unit["transfers"]) / 1e9
+            row["peak_rss"] = max([row["peak_rss"]] + [step["peak_rss"] for step in unit["steps"] if step["peak_rss"] is not None])
+            row["sites"].add(record["site"])
+    for row in samples.values():
+        row["throughput"] = ratio(row["input_gb"] * 1e3, row["wall"])
+        row["cpu_efficiency"] = ratio(row["cpu"], row["wall"])
+        row["sites"] = " ".join(sorted(row["sites"]))
+    return [samples[s] for s in sorted(samples)]
+
+def site_report(records, attempts):
+    """ One row per site: the number of jobs and retries, the input size, the total wall time, the job throughput (total and median per job),
+    the transfer throughput, the CPU efficiency and the largest peak memory of a job"""
+    sites = {}
+    for record in records:
+        row = sites.setdefault(record["site"], {"site" : record["site"], "jobs" : 0, "failed" : 0, "retries" : 0, "input_gb" : 0.0, "wall" : 0.0, "cpu" : 0.0,
+                                                "transfer_wall" : 0.0, "transfer_gb" : 0.0, "peak_rss" : 0.0, "job_throughputs" : []})
+        row["jobs"] += 1
+        row["failed"] += record["exit_code"] != 0
+        row["retries"] += attempts[record_key(record)] - 1
+        row["input_gb"] += record["input_bytes"] / 1e9
+        row["wall"] += record["wall"]
+        row["cpu"] += record["cpu"]
+        for unit in record["units"]:
+            row["transfer_wall"] += sum(t["wall"] for t in unit["transfers"])
+            row["transfer_gb"] += sum(t["bytes"] or 0 for t in unit["transfers"]) / 1e9
+        row["peak_rss"] = max(row["peak_rss"], record["peak_rss"])
+        row["job_throughputs"].append(record["throughput"])
+    for row in sites.values():
+        row["throughput"] = ratio(row["input_gb"] * 1e3, row["wall"])
+        row["median_job_throughput"] = median(row.pop("job_throughputs"))
+        row["transfer_throughput"] = ratio(row["transfer_gb"] * 1e3, row["transfer_wall"])
+        row["cpu_efficiency"] = ratio(row["cpu"], row["wall"])
+    return [sites[s] for s in sorted(sites)]
+
+def step_report(records):
+    """ One row per input size class of the merge steps: the number of steps and inputs, the median throughput, the CPU efficiency
+    and the largest peak memory. Used to tune the sizes of the merged chunks, e.g. --fan-in and --target-job-size of scripts/merge_outputs.py"""
+    classes = {}
+    for record in records:
+        for unit in record["units"]:
+            for step in unit["steps"]:
+                size = step["bytes_read"] / 1e9
+                edge = min([e for e in STEP_SIZE_CLASSES if size <= e] or [None])
+                label = "<= %g GB" % edge if edge else "> %g GB" % STEP_SIZE_CLASSES[-1]
+                row = classes.setdefault(edge or float("inf"), {"step_size" : label, "steps" : 0, "inputs" : 0, "wall" : 0.0, "cpu" : 0.0, "peak_rss" : 0.0, "rates" : []})
+                row["steps"] += 1
+                row["inputs"] += step["n_inputs"]
+                row["wall"] += step["wall"]
+                row["cpu"] += step["cpu"]
+                row["peak_rss"] = max(row["peak_rss"], step["peak_rss"] or 0.0)
+                row["rates"].append(step["rate"])
+    for row in classes.values():
+        row["median_throughput"] = median(row.pop("rates"))
+        row["cpu_efficiency"] = ratio(row["cpu"], row["wall"])
+    return [classes[c] for c in sorted(classes)]
+
+def format_value(value):
+    if isinstance(value, float):
+        return "%.2f" % value
+    return "-" if value is None else str(value)
+
+def print_report(title, rows, columns):
+    print title
+    if not rows:
+        print "\tNo entries"
+        return
+    widths = [max([len(c)] + [len(format_value(row[c])) for row in rows]) for c in columns]
+    print "\t" + "  ".join(c.rjust(w) for c, w in zip(columns, widths))
+    for row in rows:
+        print "\t" + "  ".join(format_value(row[c]).rjust(w) for c, w in zip(columns, widths))
+
+def write_csv(path, rows, columns):
+    with open(path, "w") as f:
+        writer = csv.DictWriter(f, columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+SAMPLE_COLUMNS = ["sample", "units", "input_gb", "wall", "cpu", "cpu_efficiency", "throughput", "transfer_wall", "transfer_gb", "peak_rss", "sites"]
+SITE_COLUMNS = ["site", "jobs", "failed", "retries", "input_gb", "wall", "cpu_efficiency", "throughput", "median_job_throughput", "transfer_throughput", "peak_rss"]
+STEP_COLUMNS = ["step_size", "steps", "inputs", "wall", "cpu_efficiency", "median_throughput", "peak_rss"]
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Script to collect the performance metrics of merging jobs (scripts/merge_job.py) into per-sample, per-site and per-step-size reports. Times are given in seconds, throughputs in MB/s and memory in MB.')
+    parser.add_argument('paths',nargs='*',default=['.','merging_logs'],help='Files or directories with the metrics of the jobs: the condor job outputs (.out), the logs of scripts/run_locally.py (.log) or .metrics.json files. Default: %(default)s')
+    parser.add_argument('--report-prefix',default='merging_metrics',help='Prefix of the reports in .csv format: <prefix>_samples.csv, <prefix>_sites.csv and <prefix>_steps.csv. Default: %(default)s')
+    parser.add_argument('--quiet',action='store_true',help='Do not print the per-sample report.')
+    return parser.parse_args()
+
+def main():
+    args = parseargs()
+    latest, attempts = collect_records(args.paths)
+    if not latest:
+        print "[ERROR] No metrics found in",", ".join(args.paths)
+        exit(1)
+    records = [latest[job] for job in sorted(latest)]
+    samples = sample_report(records)
+    sites = site_report(records, attempts)
+    steps = step_report(records)
+    print "Collected the metrics of %d jobs (%d attempts)" % (len(records), sum(attempts.values()))
+    if not args.quiet:
+        print_report("Samples:", samples, SAMPLE_COLUMNS)
+    print_report("Sites:", sites, SITE_COLUMNS)
+    print_report("Merge steps by input size:", steps, STEP_COLUMNS)
+    for name, rows, columns in [("samples", samples, SAMPLE_COLUMNS), ("sites", sites, SITE_COLUMNS), ("steps", steps, STEP_COLUMNS)]:
+        write_csv("%s_%s.csv" % (args.report_prefix, name), rows, columns)
+    print "Reports written to %s_{samples,sites,steps}.csv" % args.report_prefix
+
+if __name__ == "__main__":
+    main()
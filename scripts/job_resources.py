@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import json
+
+# Minimum number of suitable jobs in the metrics of previous jobs needed to calibrate a part of the resource model
+MIN_CALIBRATION_JOBS = 5
+# Minimum wall time in seconds of a job used to calibrate the throughput, shorter jobs are dominated by their overhead
+MIN_CALIBRATION_WALL = 300.0
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def round_up(value, step):
+    return int(math.ceil(value / float(step)) * step)
+
+def limit(value, limits):
+    return min(max(value, limits["min"]), limits["max"])
+
+class ResourceModel(object):
+    """ Estimates the memory, local disk and walltime requested by a merging job from the input size, the number of input files
+    and the number of pipelines of its merge units, with the parameters from configs/job_resources.json:
+
+        memory:   (base + per_pipeline * pipelines) per merging process, at least --max-merge-memory with the TFileMerger engine
+        walltime: overhead + input size / throughput + per_file * files, summed over the units of the job
+        disk:     overhead + input size * number of local copies (staged output, intermediate files, fetched partial files)
+
+    Each estimate is scaled by the safety factor and limited to [min, max] of its parameters.
+    The number of pipelines of a sample is taken from the expectations of the checks (configs/check_expectations.json)"""
+
+    def __init__(self, config, expectations=None):
+        self.config = config
+        self.expectations = expectations
+
+    def pipelines(self, sample):
+        n_pipelines = self.expectations.n_pipelines_expected(sample) if self.expectations else -1
+        return n_pipelines if n_pipelines > 0 else self.config["default_pipelines"]
+
+    def local_copies(self, unit, settings, output):
+        """ Number of copies of the input size on the local disk of the job at the same time.
+        With direct output in xrootd mode, only appending several slices in "chain" mode stages the output locally"""
+        chain_slices = settings["merge_mode"] == "chain" and not settings["resumable"] and unit["files"] > settings["fan_in"]
+        copies = 0
+        if output["mode"] == "gfal" or (output["mode"] == "xrootd" and (not output["direct"] or chain_slices)):
+            copies += 1
+        if settings["merge_mode"] == "tree" and unit["kind"] != "partial":
+            copies += 1
+        if output["mode"] == "gfal" and (unit["kind"] == "reduction" or settings["resumable"]):
+            copies += 1
+        return copies
+
+    def estimate(self, units, settings, output):
+        """ Requested memory in MB, disk in KB and walltime in seconds of a job running the given merge units (see create_merge_unit)"""
+        safety = self.config["safety_factor"]
+        m = self.config["memory"]
+        process_memory = m["base"] + m["per_pipeline"] * max(self.pipelines(u["sample"]) for u in units)
+        if settings["engine"] == "root":
+            process_memory = max(process_memory, settings["max_memory"])
+        processes = settings["merge_cores"] if settings["merge_mode"] == "tree" else 1
+        w = self.config["walltime"]
+        walltime = w["overhead"] + sum(u["size"] / 1e6 / w["throughput"] + u["files"] * w["per_file"] for u in units)
+        d = self.config["disk"]
+        disk = d["overhead"] + max(u["size"] / 1e9 * self.local_copies(u, settings, output) for u in units)
+        return {
+            "memory" : round_up(limit(process_memory * processes * safety, m), 100),
+            "disk" : round_up(limit(disk * safety, d) * 1e9 / 1024, 1000),
+            "walltime" : round_up(limit(walltime * safety, w), 600),
+        }
+
+    def calibrate(self, records):
+        """ Calibrate the model with the metrics of previous successful jobs (see scripts/collect_metrics.py): the throughput is set to the 10% quantile
+        of the job throughputs, and the memory per pipeline to the slope of a linear fit of the peak memory of the hadd jobs versus their number of pipelines,
+        with the base memory covering 90% of these jobs"""
+        import numpy as np
+        jobs = [r for r in records if r["exit_code"] == 0 and r["units"]]
+        throughputs = [r["throughput"] for r in jobs if r["wall"] >= MIN_CALIBRATION_WALL]
+        if len(throughputs) >= MIN_CALIBRATION_JOBS:
+            self.config["walltime"]["throughput"] = quantile(throughputs, 0.1)
+            print "Calibrated throughput from %d jobs: %.1f MB/s" % (len(throughputs), self.config["walltime"]["throughput"])
+        else:
+            print "[WARNING] Only %d successful jobs with at least %d s wall time found, throughput not calibrated" % (len(throughputs), MIN_CALIBRATION_WALL)
+        hadd_jobs = [r for r in jobs if r["engine"] == "hadd"]
+        if len(hadd_jobs) >= MIN_CALIBRATION_JOBS:
+            pipelines = np.array([max(self.pipelines(u["sample"]) for u in r["units"]) for r in hadd_jobs], dtype=float)
+            peak_rss = np.array([r["peak_rss"] for r in hadd_jobs], dtype=float)
+            per_pipeline = max(np.polyfit(pipelines, peak_rss, 1)[0], 0.0) if len(np.unique(pipelines)) > 1 else self.config["memory"]["per_pipeline"]
+            self.config["memory"]["per_pipeline"] = float(per_pipeline)
+            self.config["memory"]["base"] = float(quantile(peak_rss - per_pipeline * pipelines, 0.9))
+            print "Calibrated memory from %d hadd jobs: %.0f MB + %.2f MB per pipeline" % (len(hadd_jobs), self.config["memory"]["base"], per_pipeline)
+        else:
+            print "[WARNING] Only %d successful hadd jobs found, memory per pipeline not calibrated" % len(hadd_jobs)
+
+def load_resource_model(path, expectations=None):
+    return ResourceModel(json.load(open(path, "r")), expectations)
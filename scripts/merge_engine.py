@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import argparse
+import ROOT as R
+
+# Number of input files merged in the first batch. Later batches are adapted to the memory usage
+INITIAL_BATCH_SIZE = 20
+
+def current_rss():
+    """ Current resident memory of this process in MB"""
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+def merge_files(target, input_files, append=False, max_open_files=500, max_memory=1500.0, fast=True):
+    """ Merge the input files into the target with ROOT's TFileMerger within this process.
+    The inputs are added in batches, which are merged incrementally into the target. The batch size is halved, if the
+    resident memory exceeds 80% of 'max_memory' (in MB) and doubled below 50%, but never exceeds 'max_open_files'.
+    While a batch is merged, the files of the next batch are already opened asynchronously, e.g. via xrootd, as far as 'max_open_files' allows.
+    Trees are fast cloned, TTreeCloner falls back to a slow copy for trees, which can't be cloned. Returns True on success."""
+    R.gROOT.SetBatch()
+    R.gErrorIgnoreLevel = R.kWarning
+    merger = R.TFileMerger(False, False)
+    merger.SetPrintLevel(0)
+    merger.SetFastMethod(fast)
+    if not merger.OutputFile(target, "UPDATE" if append else "RECREATE"):
+        print "[ERROR] Could not open output file",target
+        return False
+    batch_size = min(max_open_files, INITIAL_BATCH_SIZE)
+    position = 0
+    start = time.time()
+    handles = []
+    while position < len(input_files):
+        if not handles:
+            handles = [R.TFile.AsyncOpen(f) for f in input_files[position:position + batch_size]]
+        batch = input_files[position:position + len(handles)]
+        files = [R.TFile.Open(h) for h in handles]
+        position += len(batch)
+        # The next batch is opened while the current one is merged, with at most 'max_open_files' inputs open at the same time
+        handles = [R.TFile.AsyncOpen(f) for f in input_files[position:position + min(batch_size, max_open_files - len(batch))]]
+        for path, F in zip(batch, files):
+            if not F or F.IsZombie():
+                print "[ERROR] Could not open input file",path
+                return False
+            merger.AddAdoptFile(F)
+        if not merger.PartialMerge(R.TFileMerger.kAllIncremental):
+            print "[ERROR] Merging of %d files into %s failed" % (len(batch), target)
+            return False
+        rss = current_rss()
+        if rss > 0.8 * max_memory:
+            batch_size = max(1, batch_size / 2)
+        elif rss < 0.5 * max_memory:
+            batch_size = min(max_open_files, batch_size * 2)
+        print "Merged %d/%d files into %s after %.0f s, memory: %.0f MB, next batch size: %d" % (position, len(input_files), target, time.time() - start, rss, batch_size)
+    merger.GetOutputFile().Close()
+    return True
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Script to merge ROOT files with TFileMerger in adaptive batches, used by scripts/merge_job.py for concurrent merges.')
+    parser.add_argument('target',help='Output file to be written.')
+    parser.add_argument('--inputs-file',required=True,help='File with the paths of the input files, one per line. This option is required to be specified.')
+    parser.add_argument('--append',action='store_true',help='Merge the inputs into the existing output file.')
+    parser.add_argument('--max-open-files',default=500,type=int,help='Maximum number of input files opened at the same time. Default: %(default)s')
+    parser.add_argument('--max-memory',default=1500.0,type=float,help='Memory in MB, to which the batch size is adapted. Default: %(default)s')
+    parser.add_argument('--no-fast',action='store_true',help='Disable fast cloning of trees.')
+    return parser.parse_args()
+
+def main():
+    args = parseargs()
+    input_files = [l.strip() for l in open(args.inputs_file, "r") if l.strip()]
+    if not merge_files(args.target, input_files, args.append, args.max_open_files, args.max_memory, not args.no_fast):
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import errno
+import hashlib
+import socket
+import zipfile
+import resource
+import argparse
+import subprocess
+from multiprocessing.pool import ThreadPool
+from root_readers import create_reader
+
+# Maximum length of the input file arguments of a single hadd call, well below the usual ARG_MAX of 2 MB.
+# Longer input lists are merged with several appending hadd calls.
+MAX_ARGUMENT_BYTES = 500000
+
+def chunks(l, size):
+    """ Split the given list into consecutive slices with at most 'size' entries"""
+    return [l[i:i + size] for i in range(0, len(l), size)]
+
+def get_file_locations(output, sd, filename):
+    """ Collect the paths and commands needed to write a file into the target directory of a sample, to read it back in a later job and to remove it again.
+    With direct output in xrootd mode, merged files are written directly to the xrootd server, and 'write' is only used as fallback."""
+    srm_path = os.path.join(output["servers"]["srm"] or "",output["directory"],sd,filename)
+    locations = {
+        "write" : filename,
+        "read" : filename,
+        "direct" : None,
+        "local_path" : None,
+        "srm" : srm_path,
+        "stage_out" : None,
+        "fetch" : None,
+        "remove" : ["gfal-rm", srm_path],
+        "upload" : ["gfal-copy", "-f", filename, srm_path],
+        "download" : ["gfal-copy", "-f", srm_path, filename],
+    }
+    if output["mode"] == "xrootd":
+        remote_path = os.path.join(output["servers"]["xrootd"],output["directory"],sd,filename)
+        locations["upload"] = ["xrdcopy", "-fs", filename, remote_path]
+        locations["stage_out"] = locations["upload"]
+        locations["read"] = remote_path
+        if output["direct"]:
+            locations["direct"] = remote_path
+    elif output["mode"] == "gsidcap":
+        locations["write"] = os.path.join(output["servers"]["dcap"],output["directory"],sd,filename)
+        locations["read"] = locations["write"]
+    elif output["mode"] == "gfal":
+        locations["stage_out"] = locations["upload"]
+        locations["fetch"] = locations["download"]
+    elif output["mode"] == "local":
+        locations["local_path"] = os.path.join("/",output["directory"],sd,filename)
+        locations["write"] = locations["local_path"]
+        locations["read"] = locations["local_path"]
+        locations["remove"] = ["rm", "-f", locations["local_path"]]
+        locations["upload"] = ["cp", "-f", filename, locations["local_path"]]
+        locations["download"] = ["cp", "-f", locations["local_path"], filename]
+    return locations
+
+def encode_inputs(input_files, file_sizes, file_mtimes):
+    """ Compact representation of the input files for a job specification: the directories are stored once,
+    each input as [directory index, file name, size, modification time]"""
+    directories = []
+    indices = {}
+    inputs = []
+    for f in input_files:
+        directory, name = os.path.split(f)
+        if directory not in indices:
+            indices[directory] = len(directories)
+            directories.append(directory)
+        inputs.append([indices[directory], name, file_sizes[f], file_mtimes[f]])
+    return directories, inputs
+
+def decode_inputs(unit):
+    """ Inverse of encode_inputs. Returns the input files with dicts of their sizes and modification times"""
+    input_files = []
+    file_sizes = {}
+    file_mtimes = {}
+    for index, name, size, mtime in unit["inputs"]:
+        f = os.path.join(unit["input_directories"][index], name)
+        input_files.append(f)
+        file_sizes[f] = size
+        file_mtimes[f] = mtime
+    return input_files, file_sizes, file_mtimes
+
+def create_manifest(sd, input_files, file_sizes, file_mtimes):
+    """ Manifest of the inputs of a sample, used to decide whether the merged output is up to date"""
+    return {"sample" : sd, "inputs" : dict((f, [file_sizes[f], file_mtimes[f]]) for f in input_files)}
+
+def inputs_fingerprint(input_files, file_sizes, file_mtimes):
+    """ Fingerprint of a list of input files with their sizes and modification times"""
+    return hashlib.sha1("\n".join("%s %d %d" % (f, file_sizes[f], file_mtimes[f]) for f in input_files)).hexdigest()
+
+def site_name():
+    """ Name of the site running the job: the CMS site name of a glidein, the CLOUDSITE of the machine on the ETP resources or the domain of the host"""
+    if os.environ.get("GLIDEIN_CMSSite"):
+        return os.environ["GLIDEIN_CMSSite"]
+    machine_ad = os.environ.get("_CONDOR_MACHINE_AD")
+    if machine_ad and os.path.exists(machine_ad):
+        for line in open(machine_ad, "r"):
+            key, _, value = line.partition("=")
+            if key.strip() == "CLOUDSITE":
+                return value.strip().strip('"')
+    host = socket.getfqdn()
+    return host.split(".", 1)[1] if "." in host else host
+
+class JobMetrics(object):
+    """ Performance metrics of a merging job. For each unit, every merge step is recorded with its wall and CPU time, the bytes read and written,
+    the throughput and the peak memory, and every transfer from or to the target directory with its duration and size.
+    The metrics are printed as a single line starting with METRICS_TAG into the output of the job, see scripts/collect_metrics.py"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.sizes = {}
+        self.units = []
+        self.content = {}
+
+    def start_job(self, job, plan, settings):
+        self.content = {"job" : job, "plan" : plan, "site" : site_name(), "host" : socket.getfqdn(), "engine" : settings["engine"], "merge_mode" : settings["merge_mode"],
+                        "fan_in" : settings["fan_in"], "start" : self.start}
+
+    def start_unit(self, unit, file_sizes):
+        self.sizes.update(file_sizes)
+        self.units.append({"name" : unit["name"], "sample" : unit["sample"], "kind" : unit["kind"], "n_inputs" : len(file_sizes),
+                           "input_bytes" : sum(file_sizes.values()), "start" : time.time(), "steps" : [], "transfers" : []})
+
+    def finish_unit(self):
+        self.units[-1]["wall"] = time.time() - self.units[-1]["start"]
+
+    def size(self, path):
+        """ Size of a file from the job specification or on the local disk, None if not known"""
+        if path in self.sizes:
+            return self.sizes[path]
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    def record_merge(self, target, input_files, exit_code, wall, usage, size_before=0):
+        bytes_read = sum(self.size(f) or 0 for f in input_files)
+        size_after = self.size(target)
+        self.units[-1]["steps"].append({"target" : os.path.basename(target), "n_inputs" : len(input_files), "exit_code" : exit_code, "wall" : wall,
+                                        "cpu" : sum(u["cpu"] for u in usage), "peak_rss" : max([u["peak_rss"] for u in usage] or [None]),
+                                        "bytes_read" : bytes_read, "bytes_written" : None if size_after is None else size_after - size_before,
+                                        "rate" : bytes_read / 1e6 / wall if wall > 0 and exit_code == 0 else None})
+
+    def record_transfer(self, cmd, local_file, usage):
+        size = os.path.getsize(local_file) if os.path.exists(local_file) else None
+        self.units[-1]["transfers"].append({"command" : cmd[0], "file" : os.path.basename(local_file), "bytes" : size, "wall" : usage["wall"]})
+
+    def finish_job(self, exit_code):
+        children_rss = peak_rss(resource.RUSAGE_CHILDREN)
+        t = os.times()
+        for unit in self.units:
+            unit.setdefault("wall", time.time() - unit["start"])
+        self.content.update({"exit_code" : exit_code, "end" : time.time(), "wall" : time.time() - self.start, "cpu" : t[0] + t[1] + t[2] + t[3],
+                             "peak_rss" : max(peak_rss(), children_rss), "units" : self.units})
+        self.content["input_bytes"] = sum(unit["input_bytes"] for unit in self.units)
+        self.content["throughput"] = self.content["input_bytes"] / 1e6 / max(self.content["wall"], 1e-3)
+        return self.content
+
+METRICS_TAG = "[METRICS] "
+
+metrics = JobMetrics()
+
+def describe(cmd):
+    if len(cmd) > 6:
+        return " ".join(cmd[:4]) + " ... (%d more arguments)" % (len(cmd) - 4)
+    return " ".join(cmd)
+
+def process_cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """ Peak resident memory in MB of this process or of the largest of its finished child processes"""
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+def call_with_usage(cmd):
+    """ Run a command and return its exit code and its resource usage: wall and CPU time in seconds and peak resident memory in MB"""
+    start = time.time()
+    p = subprocess.Popen(cmd)
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return p.returncode, {"wall" : time.time() - start, "cpu" : rusage.ru_utime + rusage.ru_stime, "peak_rss" : rusage.ru_maxrss / 1024.0}
+
+def run_command(cmd, allow_failure=False, usage=None):
+    """ Run a command, exiting on failure unless 'allow_failure' is set. The resource usage of the command is appended to 'usage', if given"""
+    print "Running:",describe(cmd)
+    sys.stdout.flush()
+    exit_code, command_usage = call_with_usage(cmd)
+    if usage is not None:
+        usage.append(command_usage)
+    if exit_code != 0 and not allow_failure:
+        print "[ERROR] Command failed with exit code %d: %s" % (exit_code, describe(cmd))
+        exit(1)
+    return exit_code
+
+def hadd_slices(input_files):
+    """ Split the input files into slices, which fit into the command line of a single hadd call"""
+    slices = [[]]
+    length = 0
+    for f in input_files:
+        if slices[-1] and length + len(f) + 1 > MAX_ARGUMENT_BYTES:
+            slices.append([])
+            length = 0
+        slices[-1].append(f)
+        length += len(f) + 1
+    return slices
+
+def run_hadd(target, input_files, append=False, allow_failure=False, usage=None):
+    """ Merge the input files into the target, appending further slices if the input list is too long for a single command line"""
+    for i, s in enumerate(hadd_slices(input_files)):
+        cmd = ["hadd", "-a", "-f", target] if append or i > 0 else ["hadd", "-f", target]
+        exit_code = run_command(cmd + s, allow_failure, usage)
+        if exit_code != 0:
+            return exit_code
+    return 0
+
+def run_merge(target, input_files, settings, append=False, allow_failure=False, concurrent=False):
+    """ Merge the input files into the target with the configured engine: "hadd" calls hadd, "root" merges with TFileMerger
+    within this process (see merge_engine.py). Concurrent merges with the "root" engine are run in separate processes.
+    The merge step is recorded in the job metrics"""
+    start = time.time()
+    size_before = os.path.getsize(target) if append and os.path.exists(target) else 0
+    usage = []
+    if settings["engine"] != "root":
+        exit_code = run_hadd(target, input_files, append, allow_failure, usage)
+    elif concurrent:
+        inputs_file = os.path.basename(target) + ".inputs"
+        with open(inputs_file, "w") as f:
+            f.write("\n".join(input_files) + "\n")
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "merge_engine.py"), target, "--inputs-file", inputs_file,
+               "--max-open-files", str(settings["max_open_files"]), "--max-memory", str(settings["max_memory"])]
+        exit_code = run_command(cmd + (["--append"] if append else []), allow_failure, usage)
+        remove_local(inputs_file)
+    else:
+        import merge_engine
+        print "Merging %d files into %s with TFileMerger" % (len(input_files), target)
+        sys.stdout.flush()
+        start_cpu = process_cpu_time()
+        exit_code = 0 if merge_engine.merge_files(target, input_files, append, settings["max_open_files"], settings["max_memory"]) else 1
+        usage.append({"wall" : time.time() - start, "cpu" : process_cpu_time() - start_cpu, "peak_rss" : peak_rss()})
+    metrics.record_merge(target, input_files, exit_code, time.time() - start, usage, size_before)
+    if exit_code != 0 and not allow_failure:
+        print "[ERROR] Merging into %s failed" % target
+        exit(1)
+    return exit_code
+
+def run_transfer(cmd, local_file, allow_failure=False):
+    """ Run a command copying a file between the job and the target directory, recorded in the job metrics with the size of the local copy"""
+    usage = []
+    try:
+        return run_command(cmd, allow_failure, usage)
+    finally:
+        if usage:
+            metrics.record_transfer(cmd, local_file, usage[0])
+
+def remove_local(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+def verify_root_file(path):
+    """ Checks, that a ROOT file can be opened, is not recovered and has the size recorded in its header, i.e. was closed properly"""
+    import ROOT as R
+    R.gROOT.SetBatch()
+    F = R.TFile.Open(path, "read")
+    if not F:
+        return False
+    ok = not F.IsZombie() and not F.TestBit(R.TFile.kRecovered) and F.GetSize() == F.GetEND()
+    F.Close()
+    return ok
+
+def stored_size(locations):
+    """ Size of a file stored in the target directory, None if not available"""
+    if locations["local_path"]:
+        return os.path.getsize(locations["local_path"]) if os.path.exists(locations["local_path"]) else None
+    p = subprocess.Popen(["gfal-ls", "-l", locations["srm"]], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    fields = out.split()
+    if p.returncode != 0 or len(fields) < 5:
+        return None
+    return int(fields[4])
+
+def read_sidecar_content(target, path):
+    """ Read the pipelines with the first bin of their cutflow histogram and the entries of their ntuple from a freshly merged file,
+    as needed by check_merged_files.py. Kept in target["sidecar_content"] to be written next to the target, if the target has a "sidecar" location"""
+    if not target.get("sidecar"):
+        return
+    for name in ["pyroot", "uproot"]:
+        try:
+            reader = create_reader(name)
+            break
+        except ImportError:
+            reader = None
+    if not reader:
+        print "[WARNING] Neither PyROOT nor uproot available, no metadata sidecar written for",path
+        return
+    try:
+        target["sidecar_content"] = reader.read_ntuple_file(path)
+    except Exception as e:
+        print "[WARNING] Could not read metadata for the sidecar from %s: %s" % (path, e)
+
+def merge_into(target, input_files, settings):
+    """ Merge the input files into the target location and stage it out, if needed.
+    With direct output, the merged file is written directly to the xrootd server and the written file is verified after closing.
+    If that fails, the remote file is removed and the target is written locally and staged out instead."""
+    if target["direct"] and (settings["engine"] == "root" or len(hadd_slices(input_files)) == 1):
+        if run_merge(target["direct"], input_files, settings, allow_failure=True) == 0 and verify_root_file(target["direct"]):
+            print "Written and verified",target["direct"]
+            read_sidecar_content(target, target["direct"])
+            return
+        print "Direct writing of %s failed, falling back to local staging" % target["direct"]
+        run_command(target["remove"], allow_failure=True)
+    run_merge(target["write"], input_files, settings)
+    read_sidecar_content(target, target["write"])
+    if target["stage_out"]:
+        run_transfer(target["stage_out"], target["write"])
+        remove_local(target["write"])
+
+def merge_chain(target, input_files, step, settings):
+    """ Serial merging: the target is appended with consecutive slices of 'step' input files.
+    A single slice is merged with merge_into, appending several slices requires local staging"""
+    if len(input_files) <= step:
+        merge_into(target, input_files, settings)
+        return
+    for i, s in enumerate(chunks(input_files, step)):
+        run_merge(target["write"], s, settings, append=i > 0)
+    read_sidecar_content(target, target["write"])
+    if target["stage_out"]:
+        run_transfer(target["stage_out"], target["write"])
+        remove_local(target["write"])
+
+def merge_tree(name, input_files, fan_in, levels, cores, settings):
+    """ Tree reduction: at each level, the current files are merged in groups of 'fan_in' into partial files on the local disk,
+    with up to 'cores' merging processes running concurrently. Stops after 'levels' levels or as soon as a single merge step suffices.
+    Returns the files left for the final reduction step and the created intermediate files."""
+    intermediate_files = []
+    current_files = input_files
+    for level in range(levels):
+        if len(current_files) <= fan_in:
+            break
+        groups = chunks(current_files, fan_in)
+        partial_files = ["%s_L%d_%d.root" % (name, level, i) for i in range(len(groups))]
+        pool = ThreadPool(cores)
+        exit_codes = pool.map(lambda i: run_merge(partial_files[i], groups[i], settings, allow_failure=True, concurrent=cores > 1), range(len(groups)))
+        pool.close()
+        intermediate_files += partial_files
+        if any(exit_codes):
+            print "[ERROR] Partial merging failed at level %d" % level
+            for f in intermediate_files:
+                remove_local(f)
+            exit(1)
+        current_files = partial_files
+    return current_files, intermediate_files
+
+def merge_tree_into(name, target, input_files, fan_in, levels, cores, settings):
+    """ Tree reduction of the input files into the target, see merge_tree"""
+    final_inputs, intermediate_files = merge_tree(name, input_files, fan_in, levels, cores, settings)
+    merge_into(target, final_inputs, settings)
+    for f in intermediate_files:
+        remove_local(f)
+
+def reduce_partials(name, target, partials, fan_in, levels, cores, settings):
+    """ Final reduction of partial merges written to the target directory. The partial files are removed from the target storage after success"""
+    for p in partials:
+        if p["fetch"]:
+            run_transfer(p["fetch"], p["read"])
+    merge_tree_into(name, target, [p["read"] for p in partials], fan_in, levels, cores, settings)
+    for p in partials:
+        run_command(p["remove"], allow_failure=True)
+        if p["fetch"]:
+            remove_local(p["read"])
+
+def read_checkpoint(checkpoint):
+    """ Download the checkpoint file of a resumable merging or a partial merge. Returns the recorded files as dict of their index to their stored size and inputs fingerprint"""
+    checkpoint_file = os.path.basename(checkpoint["srm"])
+    remove_local(checkpoint_file)
+    recorded = {}
+    if run_transfer(checkpoint["download"], checkpoint_file, allow_failure=True) == 0:
+        for line in open(checkpoint_file, "r"):
+            fields = line.split()
+            # Lines without fingerprint, e.g. from older jobs, never match
+            recorded[int(fields[0])] = (int(fields[1]), fields[2] if len(fields) > 2 else None)
+    return recorded
+
+def write_checkpoint(checkpoint, size, fingerprint):
+    """ Record a single merged file with its stored size and inputs fingerprint in a checkpoint file on the target storage, see read_checkpoint"""
+    checkpoint_file = os.path.basename(checkpoint["srm"])
+    with open(checkpoint_file, "w") as f:
+        f.write("%d %d %s\n" % (0, size, fingerprint))
+    run_transfer(checkpoint["upload"], checkpoint_file)
+    remove_local(checkpoint_file)
+
+def verify_partials(name, partials, checkpoints, fingerprints):
+    """ Check, that the partial files written by the partial merging jobs are stored with the size recorded in their checkpoints, and were merged from the planned inputs"""
+    for p, checkpoint, fingerprint in zip(partials, checkpoints, fingerprints):
+        if read_checkpoint(checkpoint).get(0) != (stored_size(p), fingerprint):
+            print "[ERROR] Partial file %s of %s is missing or was not merged from the current inputs. Run the partial merging jobs of the current plan first" % (os.path.basename(p["srm"]), name)
+            exit(1)
+        remove_local(os.path.basename(checkpoint["srm"]))
+
+def merge_resumable(name, target, checkpoint, chunk_location, groups, fingerprints, fan_in, levels, cores, settings):
+    """ Resumable merging: each group of input files is merged into a chunk file, which is stored in the target directory.
+    After each chunk, its index, stored size and the fingerprint of its inputs are appended to the checkpoint file on the target storage.
+    A restarted job skips the chunks recorded in the checkpoint, if the stored chunk file still has the recorded size and was merged from the same inputs.
+    Recorded chunks beyond the current number of groups are removed. Finally, the chunks are reduced to the target, and the chunks and the checkpoint are removed."""
+    checkpoint_file = os.path.basename(checkpoint["srm"])
+    recorded = read_checkpoint(checkpoint)
+    for i in sorted(recorded):
+        if i >= len(groups):
+            print "Removing chunk %d of %s, which is not part of the current inputs" % (i, name)
+            run_command(chunk_location(i)["remove"], allow_failure=True)
+    chunk_locations = [chunk_location(i) for i in range(len(groups))]
+    for i, (chunk, group) in enumerate(zip(chunk_locations, groups)):
+        if i in recorded and recorded[i] == (stored_size(chunk), fingerprints[i]):
+            print "Chunk %d of %s already merged, skipping" % (i, name)
+            continue
+        merge_into(chunk, group, settings)
+        size = stored_size(chunk)
+        if size is None:
+            print "[ERROR] Merged chunk %d of %s not found in the target directory" % (i, name)
+            exit(1)
+        with open(checkpoint_file, "a") as f:
+            f.write("%d %d %s\n" % (i, size, fingerprints[i]))
+        run_transfer(checkpoint["upload"], checkpoint_file)
+    reduce_partials(name, target, chunk_locations, fan_in, levels, cores, settings)
+    run_command(checkpoint["remove"], allow_failure=True)
+    remove_local(checkpoint_file)
+
+def discard_checkpoint(name, checkpoint, chunk_location):
+    """ Remove the chunks and the checkpoint of an earlier resumable merging, which is not continued, since the sample is now merged without chunks"""
+    recorded = read_checkpoint(checkpoint)
+    if recorded:
+        print "Removing %d chunks of an earlier resumable merging of %s" % (len(recorded), name)
+        for i in sorted(recorded):
+            run_command(chunk_location(i)["remove"], allow_failure=True)
+        run_command(checkpoint["remove"], allow_failure=True)
+    remove_local(os.path.basename(checkpoint["srm"]))
+
+def write_json(locations, content):
+    """ Write a small .json file into the target directory"""
+    json_file = os.path.basename(locations["srm"])
+    with open(json_file, "w") as f:
+        json.dump(content, f, sort_keys=True)
+    run_transfer(locations["upload"], json_file)
+    remove_local(json_file)
+
+def run_unit(unit, output, settings):
+    """ Run a merging unit of a job: "partial" merges a part of the inputs of a sample into a partial file in the target directory,
+    "reduction" merges the partial files of a sample into its target, and "sample" merges all inputs of a sample into its target.
+    After "reduction" and "sample", the manifest of the inputs and the metadata sidecar for check_merged_files.py are written next to the target."""
+    print "Merging",unit["name"]
+    sd = unit["sample"]
+    input_files, file_sizes, file_mtimes = decode_inputs(unit)
+    if not input_files:
+        print "[ERROR] No input files for merging unit %s" % unit["name"]
+        exit(1)
+    fan_in = settings["fan_in"]
+    target = get_file_locations(output, sd, unit["name"] + ".root")
+    if unit["kind"] == "partial":
+        merge_tree_into(unit["name"], target, input_files, fan_in, 0, 1, settings)
+        size = stored_size(target)
+        if size is None:
+            print "[ERROR] Merged partial file %s not found in the target directory" % unit["name"]
+            exit(1)
+        write_checkpoint(get_file_locations(output, sd, unit["name"] + ".checkpoint"), size, inputs_fingerprint(input_files, file_sizes, file_mtimes))
+        return
+    manifest_locations = get_file_locations(output, sd, sd + ".manifest.json")
+    target["sidecar"] = get_file_locations(output, sd, sd + ".check.json")
+    run_command(manifest_locations["remove"], allow_failure=True)
+    run_command(target["sidecar"]["remove"], allow_failure=True)
+    checkpoint = get_file_locations(output, sd, sd + ".checkpoint")
+    chunk_location = lambda i: get_file_locations(output, sd, "%s_chunk%d.root" % (sd, i))
+    if unit["kind"] == "reduction":
+        partials = [get_file_locations(output, sd, p + ".root") for p, fingerprint in unit["partials"]]
+        partial_checkpoints = [get_file_locations(output, sd, p + ".checkpoint") for p, fingerprint in unit["partials"]]
+        verify_partials(unit["name"], partials, partial_checkpoints, [fingerprint for p, fingerprint in unit["partials"]])
+        reduce_partials(unit["name"], target, partials, fan_in, settings["merge_levels"] - 1, settings["merge_cores"], settings)
+        for checkpoint in partial_checkpoints:
+            run_command(checkpoint["remove"], allow_failure=True)
+    elif settings["resumable"] and len(input_files) > fan_in:
+        groups = chunks(input_files, fan_in)
+        fingerprints = [inputs_fingerprint(group, file_sizes, file_mtimes) for group in groups]
+        levels = settings["merge_levels"] - 1 if settings["merge_mode"] == "tree" else 0
+        merge_resumable(unit["name"], target, checkpoint, chunk_location, groups, fingerprints, fan_in, levels, settings["merge_cores"], settings)
+    else:
+        if settings["resumable"]:
+            discard_checkpoint(unit["name"], checkpoint, chunk_location)
+        if settings["merge_mode"] == "chain":
+            merge_chain(target, input_files, fan_in, settings)
+        else:
+            merge_tree_into(unit["name"], target, input_files, fan_in, settings["merge_levels"], settings["merge_cores"], settings)
+    size = stored_size(target)
+    write_json(manifest_locations, dict(create_manifest(sd, input_files, file_sizes, file_mtimes), size=size))
+    if target.get("sidecar_content"):
+        if size is None:
+            print "[WARNING] Size of the merged file of %s not available, no sidecar written" % sd
+        else:
+            write_json(target["sidecar"], dict(target["sidecar_content"], sample=sd, file=sd + ".root", size=size))
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Script to run a merging job from the job bundle created by scripts/merge_outputs.py.')
+    parser.add_argument('job',help='Name of the job to be run, as listed in arguments.txt.')
+    parser.add_argument('--bundle',default='merging.zip',help='Job bundle with the job specifications. Default: %(default)s')
+    parser.add_argument('--metrics-file',default=None,help='File, into which the performance metrics of the job are written in .json format, in addition to the output of the job. Default: %(default)s')
+    return parser.parse_args()
+
+def main():
+    args = parseargs()
+    bundle = zipfile.ZipFile(args.bundle, "r")
+    job = json.loads(bundle.read("%s.json" % args.job))
+    bundle.close()
+    if job["settings"]["engine"] == "root":
+        try:
+            import merge_engine
+        except ImportError as e:
+            print "[WARNING] TFileMerger engine not available (%s), falling back to hadd" % e
+            job["settings"]["engine"] = "hadd"
+    if job["output"]["direct"]:
+        try:
+            import ROOT
+        except ImportError as e:
+            print "[WARNING] PyROOT needed to verify directly written files not available (%s), staging the output locally" % e
+            job["output"]["direct"] = False
+    metrics.start_job(args.job, job.get("plan"), job["settings"])
+    exit_code = 1
+    try:
+        for unit in job["units"]:
+            metrics.start_unit(unit, decode_inputs(unit)[1])
+            run_unit(unit, job["output"], job["settings"])
+            metrics.finish_unit()
+        exit_code = 0
+    except SystemExit as e:
+        exit_code = e.code
+        raise
+    finally:
+        content = metrics.finish_job(exit_code)
+        print METRICS_TAG + json.dumps(content, sort_keys=True)
+        if args.metrics_file:
+            with open(args.metrics_file, "w") as f:
+                json.dump(content, f, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
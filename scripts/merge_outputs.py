@@ -3,12 +3,18 @@
 
 import os
 import re
-import glob
+import json
+import time
+import uuid
 import gfal2
-import tarfile
-from XRootD import client
-from XRootD.client.flags import DirListFlags, OpenFlags, MkDirFlags, QueryCode, StatInfoFlags
+import zipfile
 import argparse
+from multiprocessing import Pool
+from storage_listing import StorageLister
+from merge_job import get_file_locations, encode_inputs, create_manifest, inputs_fingerprint
+from job_resources import load_resource_model
+from check_expectations import load_expectations
+from collect_metrics import collect_records
 
 def sorted_nicely(l):
     """ Sort the given iterable in the way that humans expect: alphanumeric sort (in bash, that's 'sort -V')"""
@@ -21,6 +27,209 @@ def nullable_string(val):
         return None
     return val
 
+def read_manifest(manifest_locations, gfalclient):
+    """ Read the manifest of an already merged sample from the target storage. Returns None, if not available"""
+    try:
+        if gfalclient:
+            f = gfalclient.open(manifest_locations["srm"], "r")
+            content = f.read(gfalclient.stat(manifest_locations["srm"]).st_size)
+        else:
+            content = open(manifest_locations["read"], "r").read()
+        return json.loads(content)
+    except (IOError, OSError, ValueError, gfal2.GError):
+        return None
+
+def stored_size(locations, gfalclient):
+    """ Size of a file on the target storage, None if not available"""
+    try:
+        if gfalclient:
+            return gfalclient.stat(locations["srm"]).st_size
+        return os.path.getsize(locations["read"])
+    except (OSError, gfal2.GError):
+        return None
+
+def up_to_date(sd, manifest, output, gfalclient):
+    """ A sample is up to date, if its stored manifest lists the same input files, and its merged file is stored with the size recorded in the manifest"""
+    stored_manifest = read_manifest(get_file_locations(output, sd, sd+".manifest.json"), gfalclient)
+    if stored_manifest is None or stored_manifest["inputs"] != manifest["inputs"] or stored_manifest.get("size") is None:
+        return False
+    return stored_size(get_file_locations(output, sd, sd+".root"), gfalclient) == stored_manifest["size"]
+
+def remove_stale_partials(sd, target_directory_path, partials, gfalclient):
+    """ Remove the partial files <sample>_part<i>.root and their checkpoints from the target directory of a sample, which are not part of its current plan"""
+    pattern = re.compile(r"^%s_part\d+\.(root|checkpoint)$" % re.escape(sd))
+    try:
+        names = gfalclient.listdir(target_directory_path) if gfalclient else os.listdir(target_directory_path)
+    except (OSError, gfal2.GError) as e:
+        print "[WARNING] Could not list %s to remove stale partial files: %s" % (target_directory_path, e)
+        return
+    for name in names:
+        if pattern.match(name) and os.path.splitext(name)[0] not in partials:
+            print "Removing stale partial file",os.path.join(target_directory_path,name)
+            if gfalclient:
+                gfalclient.unlink(os.path.join(target_directory_path,name))
+            else:
+                os.remove(os.path.join(target_directory_path,name))
+
+def validate_input_file(input_file):
+    """ Pre-flight check of an input file with the same tests applied to the merged files by check_merged_files.py:
+    the file has to be openable, neither a zombie nor recovered, and has to contain keys. Returns the file and the reason of failure, None if it is fine"""
+    import ROOT as R
+    R.gROOT.SetBatch()
+    F = R.TFile.Open(input_file, "read")
+    if not F:
+        return input_file, "not readable"
+    if F.IsZombie():
+        reason = "zombie"
+    elif F.TestBit(R.TFile.kRecovered):
+        reason = "recovered"
+    elif F.GetNkeys() == 0:
+        reason = "no keys"
+    else:
+        reason = None
+    F.Close()
+    return input_file, reason
+
+def validate_inputs(input_files, file_sizes, file_mtimes, processes, cache_file):
+    """ Validate the input files concurrently with a pool of processes. The results are cached in 'cache_file' together with the size and
+    modification time of each file, such that unchanged files are not opened again. Files, which could not be read, are not cached.
+    Returns a dict with the reason of failure for each bad input file"""
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        try:
+            cache = json.load(open(cache_file, "r"))
+        except ValueError:
+            print "[WARNING] Ignoring corrupted validation cache",cache_file
+    bad_inputs = {}
+    to_check = []
+    n_cached = 0
+    for f in input_files:
+        cached = cache.get(f)
+        if file_sizes[f] == 0:
+            bad_inputs[f] = "empty"
+        elif cached and cached["size"] == file_sizes[f] and cached["mtime"] == file_mtimes[f]:
+            n_cached += 1
+            if cached["reason"]:
+                bad_inputs[f] = cached["reason"]
+        else:
+            to_check.append(f)
+    print "Validating %d input files, %d taken from the cache" % (len(to_check), n_cached)
+    if to_check:
+        pool = Pool(min(processes, len(to_check)))
+        for i, (f, reason) in enumerate(pool.imap_unordered(validate_input_file, to_check, chunksize=10)):
+            if reason:
+                bad_inputs[f] = reason
+            if reason != "not readable":
+                cache[f] = {"size" : file_sizes[f], "mtime" : file_mtimes[f], "reason" : reason}
+            if (i + 1) % 1000 == 0:
+                print "\tValidated %d/%d files" % (i + 1, len(to_check))
+        pool.close()
+        pool.join()
+    if cache_file:
+        # Entries of removed files in the validated directories are evicted
+        input_set = set(input_files)
+        directories = set(os.path.dirname(f) for f in input_files)
+        for f in [f for f in cache if f not in input_set and os.path.dirname(f) in directories]:
+            cache.pop(f)
+        json.dump(cache, open(cache_file, "w"))
+    return bad_inputs
+
+def split_by_load(input_files, file_sizes, capacity, per_file_load, max_files):
+    """ Split the input files of a sample into consecutive groups with a load (size + per file overhead) below the capacity and at most 'max_files' files"""
+    groups = [[]]
+    load = 0
+    for f in input_files:
+        file_load = file_sizes[f] + per_file_load
+        if groups[-1] and (load + file_load > capacity or len(groups[-1]) >= max_files):
+            groups.append([])
+            load = 0
+        groups[-1].append(f)
+        load += file_load
+    return groups
+
+def create_merge_unit(name, sample, kind, input_files, file_sizes, file_mtimes, per_file_load, partials=None):
+    """ Merging unit with its specification for scripts/merge_job.py and its predicted load"""
+    size = sum(file_sizes[f] for f in input_files)
+    input_directories, inputs = encode_inputs(input_files, file_sizes, file_mtimes)
+    spec = {"name" : name, "sample" : sample, "kind" : kind, "input_directories" : input_directories, "inputs" : inputs}
+    if partials:
+        spec["partials"] = partials
+    return {"name" : name, "sample" : sample, "kind" : kind, "spec" : spec, "size" : size, "files" : len(input_files), "load" : size + len(input_files) * per_file_load}
+
+def pack_merge_units(merge_units, capacity):
+    """ First-fit decreasing bin packing of the merge units into jobs with a load below the capacity. Returns a dict with the job names as keys"""
+    bins = []
+    for unit in sorted(merge_units, key=lambda u: u["load"], reverse=True):
+        for b in bins:
+            if b["load"] + unit["load"] <= capacity:
+                b["units"].append(unit)
+                b["load"] += unit["load"]
+                break
+        else:
+            bins.append({"units" : [unit], "load" : unit["load"]})
+    return dict(("job%d" % i, b["units"]) for i, b in enumerate(bins))
+
+def storage_endpoint(path):
+    """ Storage endpoint of a path: the server of a URL, or the mount point of a local path"""
+    if "://" in path:
+        return "/".join(path.split("/")[:3])
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+def job_endpoint(units):
+    """ Storage endpoint, from which the merge units of a job read most of their input size"""
+    sizes = {}
+    for u in units:
+        endpoints = [storage_endpoint(d) for d in u["spec"]["input_directories"]]
+        for index, name, size, mtime in u["spec"]["inputs"]:
+            sizes[endpoints[index]] = sizes.get(endpoints[index], 0) + size
+    return max(sizes, key=sizes.get) if sizes else "unknown"
+
+def create_job_summary(units, stage, endpoint):
+    """ Summary of a job for merging_plan.json. The endpoint is the storage the job reads its inputs from"""
+    return {
+        "stage" : stage,
+        "endpoint" : endpoint,
+        "units" : [u["name"] for u in units],
+        "samples" : sorted(set(u["sample"] for u in units)),
+        "size" : sum(u["size"] for u in units),
+        "files" : sum(u["files"] for u in units),
+        "load" : sum(u["load"] for u in units),
+    }
+
+def write_arguments(path, names, plan):
+    """ Write the jobs with their requested memory in MB, disk in KB and walltime in seconds, as read by 'queue arguments,job_memory,job_disk,job_walltime from ...' in configs/*.jdl"""
+    with open(path, "w") as f:
+        f.write("\n".join(["%s %d %d %d" % (name, plan[name]["request"]["memory"], plan[name]["request"]["disk"], plan[name]["request"]["walltime"]) for name in sorted_nicely(names)]))
+
+def print_requests(summaries):
+    """ Print the range of the resources requested by the jobs"""
+    if not summaries:
+        return
+    print "Requested resources of %d jobs (min / median / max):" % len(summaries)
+    for key, unit, scale in [("memory", "MB", 1.0), ("disk", "GB", 1024 / 1e9), ("walltime", "h", 1 / 3600.0)]:
+        values = sorted(s["request"][key] * scale for s in summaries)
+        print "\t%s: %.1f / %.1f / %.1f %s" % (key, values[0], values[len(values) / 2], values[-1], unit)
+
+def print_load_distribution(summaries):
+    """ Print the predicted distribution of the job loads as quantiles and as histogram"""
+    if not summaries:
+        return
+    loads = sorted(s["load"] / 1e9 for s in summaries)
+    files = sorted(s["files"] for s in summaries)
+    print "Predicted load for %d merging jobs (in GB including the per file overhead):" % len(loads)
+    print "\tmin = %.2f, median = %.2f, mean = %.2f, max = %.2f" % (loads[0], loads[len(loads) / 2], sum(loads) / len(loads), loads[-1])
+    print "\tfiles per job: min = %d, median = %d, max = %d" % (files[0], files[len(files) / 2], files[-1])
+    n_bins = 10
+    width = (loads[-1] - loads[0]) / n_bins or 1.0
+    counts = [0] * n_bins
+    for l in loads:
+        counts[min(int((l - loads[0]) / width), n_bins - 1)] += 1
+    for i, c in enumerate(counts):
+        print "\t[%8.2f, %8.2f) %5d %s" % (loads[0] + i * width, loads[0] + (i + 1) * width, c, "#" * int(50.0 * c / max(counts)))
+
 def parseargs():
     parser = argparse.ArgumentParser(description='Small script to merge artus outputs from local or xrootd resources using multiprocessing.')
     parser.add_argument('--xrootd-input-server',default='root://cmsxrootd-kit.gridka.de/',type=nullable_string,help='xrootd server to access your input files and to create the output directory. Only used in xrootd mode. Default: %(default)s')
@@ -32,6 +241,30 @@ def parseargs():
     parser.add_argument('--main-output-directory',default='/pnfs/gridka.de/cms/disk-only/store/user/',help='output directory path on the machine or server to the "user" directory. Default: %(default)s')
     parser.add_argument('--target-directory',help='directory at you target srm server (from your username on) where the merged outputs should be written. This option is required to be specified.',required=True)
     parser.add_argument('--match-to-sample-regex',default='.*',help='directory at you target srm server (from your username on) where the merged outputs should be written. Default: %(default)s')
+    parser.add_argument('--merge-mode',default='chain',choices=['chain','tree'],help='"chain": the target is appended serially with slices of --fan-in files. "tree": slices of --fan-in files are merged independently into partial files, which are reduced to the target in a final step. Default: %(default)s')
+    parser.add_argument('--fan-in',default=2000,type=int,help='Maximum number of files merged in a single merging step. Default: %(default)s')
+    parser.add_argument('--merge-levels',default=1,type=int,help='Maximum number of partial merge levels before the final reduction step in "tree" mode. Default: %(default)s')
+    parser.add_argument('--merge-cores',default=1,type=int,help='Number of partial merges running concurrently within a job in "tree" mode. Default: %(default)s')
+    parser.add_argument('--merge-engine',default='root',choices=['root','hadd'],help='"root": merge with TFileMerger within the merging job, in batches adapted to --max-merge-memory and prefetching the next inputs. Falls back to "hadd", if PyROOT is not available on the worker. "hadd": call hadd. Default: %(default)s')
+    parser.add_argument('--max-open-files',default=500,type=int,help='Maximum number of input files opened at the same time by the "root" merge engine. Default: %(default)s')
+    parser.add_argument('--max-merge-memory',default=1500.0,type=float,help='Memory in MB, to which the batches of the "root" merge engine are adapted. Concurrent merges in "tree" mode use this amount each. Default: %(default)s')
+    parser.add_argument('--listing-threads',default=10,type=int,help='Number of directories listed concurrently on the input storage. Default: %(default)s')
+    parser.add_argument('--listing-cache',default='listing_cache.json',help='File to cache the directory listings of the input storage. Default: %(default)s')
+    parser.add_argument('--listing-cache-ttl',default=0,type=float,help='Time in seconds, for which cached directory listings are reused. Disabled for values <= 0. Default: %(default)s')
+    parser.add_argument('--direct-output',action='store_true',help='In xrootd output mode, write the merged files directly to the xrootd output server instead of staging them on the local disk. The written files are verified, and local staging is used as fallback. Appending slices in "chain" mode still requires local staging.')
+    parser.add_argument('--resumable',action='store_true',help='Merge samples with more than --fan-in input files chunk by chunk into files in the target directory, recording the finished chunks in a checkpoint file next to them. A restarted job continues with the first chunk not yet merged.')
+    parser.add_argument('--incremental',action='store_true',help='Skip samples, for which the manifest written next to the merged output shows, that their input files (paths, sizes and modification times) have not changed since the last successful merging, and that the merged file is still stored with the size recorded in the manifest.')
+    parser.add_argument('--validate-inputs',action='store_true',help='Open all input files before planning the jobs and check, that they are non-empty, neither zombies nor recovered and contain keys. Bad files are listed in bad_inputs.txt.')
+    parser.add_argument('--bad-inputs',default='exclude',choices=['exclude','abort'],help='Treatment of bad input files found by --validate-inputs: "exclude" them from merging or "abort" the planning. Default: %(default)s')
+    parser.add_argument('--validation-processes',default=10,type=int,help='Number of input files validated concurrently. Default: %(default)s')
+    parser.add_argument('--validation-cache',default='validation_cache.json',help='File to cache the validation results per input file with its size and modification time. Default: %(default)s')
+    parser.add_argument('--job-planning',default='sample',choices=['sample','packed'],help='"sample": one merging job per sample. "packed": small samples are packed into common jobs and samples above --target-job-size are split into partial merging jobs with a final reduction, based on the input sizes. Default: %(default)s')
+    parser.add_argument('--target-job-size',default=50.0,type=float,help='Maximum load of a merging job in GB for the "packed" job planning. Default: %(default)s')
+    parser.add_argument('--per-file-load',default=10.0,type=float,help='Overhead of opening an input file, expressed as additional load in MB. Default: %(default)s')
+    parser.add_argument('--partial-jobs',action='store_true',help='In "tree" mode, run the first level of partial merges as separate jobs (arguments.txt) writing to the target directory. The final reductions are collected in arguments_reduction.txt and need to be run after the partial merges have finished.')
+    parser.add_argument('--resource-model',default='configs/job_resources.json',help='File in .json format with the parameters of the model, from which the memory, disk and walltime requested by each job are estimated. The requests are written as additional columns into arguments.txt. Default: %(default)s')
+    parser.add_argument('--expectations',default='configs/check_expectations.json',help='File in .json format with the expected numbers of pipelines per sample pattern, used by the resource model. Default: %(default)s')
+    parser.add_argument('--calibration-metrics',default=[],nargs='*',help='Files or directories with the metrics of previous merging jobs (see scripts/collect_metrics.py), from which the throughput and the memory of the resource model are calibrated. Default: %(default)s')
 
     return parser.parse_args()
 
@@ -65,57 +298,122 @@ def main():
         print "\tlocal: no srm, no dcap & no xrootd output server"
         exit(1)
 
+    if args.partial_jobs and args.merge_mode != "tree":
+        print "Partial merging jobs can only be used with --merge-mode tree."
+        exit(1)
+    if args.fan_in < 2 or args.merge_levels < 1 or args.merge_cores < 1 or args.max_open_files < 1 or args.validation_processes < 1:
+        print "--fan-in needs to be at least 2, --merge-levels, --merge-cores, --max-open-files and --validation-processes at least 1."
+        exit(1)
+    output_servers = {
+        "xrootd" : xrootd_output_server,
+        "srm" : srm_server,
+        "dcap" : dcap_server,
+    }
+
+    if args.direct_output and not output_modes["xrootd"]:
+        print "Direct output can only be used in xrootd output mode."
+        exit(1)
+
     main_input_directory = args.main_input_directory.strip("/")
     main_output_directory = args.main_output_directory.strip("/")
     sample_directories = [ d.strip("/") for d in args.sample_directories]
     sample_pattern = args.match_to_sample_regex
     target_directory = args.target_directory.strip("/")
     input_directories = [ os.path.join(main_input_directory,sample_directory) for sample_directory in sample_directories]
+    output = {
+        "mode" : [m for m in ["xrootd", "gsidcap", "gfal", "local"] if output_modes[m]][0],
+        "servers" : output_servers,
+        "directory" : os.path.join(main_output_directory,target_directory),
+        "direct" : args.direct_output,
+    }
+    settings = {
+        "merge_mode" : args.merge_mode,
+        "fan_in" : args.fan_in,
+        "merge_levels" : args.merge_levels,
+        "merge_cores" : args.merge_cores,
+        "resumable" : args.resumable,
+        "engine" : args.merge_engine,
+        "max_open_files" : args.max_open_files,
+        "max_memory" : args.max_merge_memory,
+    }
 
-    if input_modes["xrootd"]:
-        xrootdclient = client.FileSystem(xrootd_input_server)
+    resource_model = load_resource_model(args.resource_model, load_expectations(args.expectations))
+    if args.calibration_metrics:
+        latest, _ = collect_records(args.calibration_metrics)
+        resource_model.calibrate(latest.values())
+
+    gfalclient = None
     if output_modes["gsidcap"] or output_modes["gfal"] or output_modes["xrootd"]:
         gfalclient = gfal2.creat_context()
+    lister = StorageLister(xrootd_input_server, args.listing_threads, args.listing_cache, args.listing_cache_ttl)
 
     dataset_dict = {}
+    file_sizes = {}
+    file_mtimes = {}
+    if input_modes["xrootd"]:
+        print "Investigating via xrdfs:"," ".join([os.path.join("/",d) for d in input_directories])
+    listings = lister.list_directories(input_directories)
+    sample_dir_list = []
     for input_directory in input_directories:
-        if input_modes["xrootd"]:
-            status, listing = xrootdclient.dirlist(input_directory, DirListFlags.STAT)
-            print "Investigating via xrdfs:",os.path.join("/",input_directory)
-            sample_dirs = [ entry.name.strip("/") for entry in listing if (entry.statinfo.flags & StatInfoFlags.IS_DIR) and re.search(sample_pattern,entry.name)]
-        elif input_modes["local"]:
-            sample_dirs = [os.path.basename(name).strip("/") for name in glob.glob(os.path.join("/",input_directory,"*")) if os.path.isdir(name) and re.search(sample_pattern,name)]
-            if len(sample_dirs) == 0:
-                print "[ERROR] No sample dir found for input input_directory %s. Aborting..." % input_directory
-                raise Exception
-
-        for sd in sample_dirs:
-            sample_dir = os.path.join(input_directory,sd)
-            if input_modes["xrootd"]:
-                s, dataset_listing = xrootdclient.dirlist(sample_dir, DirListFlags.STAT)
-                input_files = [os.path.join(xrootd_input_server,sample_dir,entry.name) for entry in dataset_listing if ".root" in entry.name]
-            elif input_modes["local"]:
-                input_files = glob.glob(os.path.join("/",sample_dir,"*.root"))
-                if len(input_files) == 0:
-                    print "[ERROR] No input file for path %s found. Aborting..." % sample_dir
-                    raise Exception
-
-            dataset_dict.setdefault(sd, [])
-            dataset_dict[sd] += input_files
-
-    tar = tarfile.open("merging.tar.gz","w:gz")
-    for sd in sorted_nicely(dataset_dict.keys()):
-        if output_modes["xrootd"]:
-            target_remote_path = os.path.join(xrootd_output_server,main_output_directory,target_directory,sd,sd+".root")
-            target_path = os.path.join(sd+".root")
-        if output_modes["gsidcap"]:
-            target_path = os.path.join(dcap_server,main_output_directory,target_directory,sd,sd+".root")
-        elif output_modes["gfal"]:
-            target_remote_path = os.path.join(srm_server,main_output_directory,target_directory,sd,sd+".root")
-            target_path = os.path.join(sd+".root")
-        elif output_modes["local"]:
-            target_path = os.path.join("/",main_output_directory,target_directory,sd,sd+".root")
+        if listings[input_directory] is None:
+            print "[ERROR] Could not list input directory %s. Aborting..." % input_directory
+            exit(1)
+        sample_dirs = [ entry["name"] for entry in listings[input_directory] if entry["is_dir"] and re.search(sample_pattern,entry["name"])]
+        if input_modes["local"] and len(sample_dirs) == 0:
+            print "[ERROR] No sample dir found for input input_directory %s. Aborting..." % input_directory
+            raise Exception
+        sample_dir_list += [(os.path.join(input_directory,sd), sd) for sd in sample_dirs]
+
+    sample_listings = lister.list_directories([sample_dir for sample_dir, sd in sample_dir_list])
+    for sample_dir, sd in sample_dir_list:
+        input_files = []
+        if sample_listings[sample_dir] is None:
+            print "[ERROR] Could not list sample directory %s. Aborting..." % sample_dir
+            exit(1)
+        for entry in sample_listings[sample_dir]:
+            if entry["name"].endswith(".root") and not entry["is_dir"]:
+                if input_modes["xrootd"]:
+                    input_file = os.path.join(xrootd_input_server,sample_dir,entry["name"])
+                elif input_modes["local"]:
+                    input_file = os.path.join("/",sample_dir,entry["name"])
+                file_sizes[input_file] = entry["size"]
+                file_mtimes[input_file] = entry["mtime"]
+                input_files.append(input_file)
+        if input_modes["local"] and len(input_files) == 0:
+            print "[ERROR] No input file for path %s found. Aborting..." % sample_dir
+            raise Exception
+
+        dataset_dict.setdefault(sd, [])
+        dataset_dict[sd] += input_files
 
+    if os.path.exists("bad_inputs.txt"):
+        os.remove("bad_inputs.txt")
+    if args.validate_inputs:
+        all_input_files = [f for sd in dataset_dict for f in dataset_dict[sd]]
+        bad_inputs = validate_inputs(all_input_files, file_sizes, file_mtimes, args.validation_processes, args.validation_cache)
+        if bad_inputs:
+            with open("bad_inputs.txt", "w") as f:
+                f.write("\n".join(["%s %s" % (b, bad_inputs[b]) for b in sorted_nicely(bad_inputs.keys())]) + "\n")
+            print "[WARNING] Found %d bad input files, listed in bad_inputs.txt" % len(bad_inputs)
+            if args.bad_inputs == "abort":
+                print "[ERROR] Aborting due to bad input files."
+                exit(1)
+            for sd in dataset_dict.keys():
+                dataset_dict[sd] = [f for f in dataset_dict[sd] if f not in bad_inputs]
+                if not dataset_dict[sd]:
+                    print "[WARNING] No valid input files left for %s, skipping it" % sd
+                    dataset_dict.pop(sd)
+
+    merge_units = []
+    reduction_jobs = {}
+    capacity = args.target_job_size * 1e9 if args.job_planning == "packed" else float("inf")
+    per_file_load = args.per_file_load * 1e6
+    up_to_date_samples = []
+    for sd in sorted_nicely(dataset_dict.keys()):
+        manifest = create_manifest(sd, dataset_dict[sd], file_sizes, file_mtimes)
+        if args.incremental and up_to_date(sd, manifest, output, gfalclient):
+            up_to_date_samples.append(sd)
+            continue
         if output_modes["gsidcap"] or output_modes["gfal"] or output_modes["xrootd"]:
             target_directory_path = os.path.join(srm_server,main_output_directory,target_directory,sd)
             gfalclient.mkdir_rec(target_directory_path,0755)
@@ -124,33 +422,54 @@ def main():
             if not os.path.exists(target_directory_path):
                 os.makedirs(target_directory_path)
 
-        print sd,"has files:",len(dataset_dict[sd])
-        step = 2000
-        indices_list = []
-        i = 0
-        while i * step < len(dataset_dict[sd]):
-            indices_list.append(i)
-            i+= 1
-        hadd_cmd = "rm -f " + target_path + ";\n"
-        for i in indices_list[:-1]:
-            #print "\t", i * step, (i + 1) * step
-            hadd_cmd += "hadd -a -f " + target_path + " " + " ".join(dataset_dict[sd][i * step:(i + 1) * step]) + ";\n"
-        #print "\t", indices_list[-1] * step
-        hadd_cmd += "hadd -a -f " + target_path + " " + " ".join(dataset_dict[sd][indices_list[-1] * step:])
-        if output_modes["gfal"]:
-            hadd_cmd += ";\ngfal-copy -f " + target_path + " " + target_remote_path
-        elif output_modes["xrootd"]:
-            hadd_cmd += ";\nxrdcopy -fs " + target_path + " " + target_remote_path
-        hadd_filename = "%s.sh"%sd
-        with open(hadd_filename,"w") as f:
-            f.write(hadd_cmd)
-            f.close()
-        tar.add(hadd_filename)
-        os.remove(hadd_filename)
-    tar.close()
-    with open("arguments.txt","w") as f:
-        f.write("\n".join(sorted_nicely(dataset_dict.keys())))
-        f.close()
+        input_files = dataset_dict[sd]
+        sample_size = sum(file_sizes[f] for f in input_files)
+        print sd,"has files:",len(input_files),"with size: %.2f GB" % (sample_size / 1e9)
+        partials = []
+        if sample_size + len(input_files) * per_file_load > capacity or (args.partial_jobs and len(input_files) > args.fan_in):
+            for i, group in enumerate(split_by_load(input_files, file_sizes, capacity, per_file_load, args.fan_in)):
+                name = "%s_part%d" % (sd, i)
+                merge_units.append(create_merge_unit(name, sd, "partial", group, file_sizes, file_mtimes, per_file_load))
+                partials.append([name, inputs_fingerprint(group, file_sizes, file_mtimes)])
+            reduction_jobs[sd] = create_merge_unit(sd, sd, "reduction", input_files, file_sizes, file_mtimes, per_file_load, partials)
+        else:
+            merge_units.append(create_merge_unit(sd, sd, "sample", input_files, file_sizes, file_mtimes, per_file_load))
+        remove_stale_partials(sd, target_directory_path, [p for p, fingerprint in partials], gfalclient)
+    if up_to_date_samples:
+        print "Skipping %d samples with unchanged inputs since the last merging:" % len(up_to_date_samples)
+        for sd in up_to_date_samples:
+            print "\t",sd
+
+    if args.job_planning == "packed":
+        jobs = pack_merge_units(merge_units, capacity)
+    else:
+        jobs = dict((unit["name"], [unit]) for unit in merge_units)
+    plan = {}
+    for name, units in jobs.items():
+        plan[name] = create_job_summary(units, "merge", job_endpoint(units))
+    for name, unit in reduction_jobs.items():
+        jobs[name] = [unit]
+        plan[name] = create_job_summary([unit], "reduction", storage_endpoint(xrootd_output_server or dcap_server or srm_server or os.path.join("/",main_output_directory)))
+    print_load_distribution([plan[name] for name in plan if plan[name]["stage"] == "merge"])
+    for name in plan:
+        plan[name]["request"] = resource_model.estimate(jobs[name], settings, output)
+    print_requests(plan.values())
+
+    # Job names are reused by later plans, the plan id distinguishes their metrics
+    plan_id = "%s_%s" % (time.strftime("%Y%m%d_%H%M%S"), uuid.uuid4().hex[:8])
+    print "Plan id:",plan_id
+    bundle = zipfile.ZipFile("merging.zip","w",zipfile.ZIP_DEFLATED)
+    for name, units in jobs.items():
+        bundle.writestr("%s.json"%name, json.dumps({"plan" : plan_id, "output" : output, "settings" : settings, "units" : [unit["spec"] for unit in units]}))
+    bundle.close()
+    json.dump(plan,open("merging_plan.json","w"),sort_keys=True,indent=2)
+    write_arguments("arguments.txt", [name for name in plan if plan[name]["stage"] == "merge"], plan)
+    if reduction_jobs:
+        print "Partial merges are written to arguments.txt, the final reductions of %d samples to arguments_reduction.txt." % len(reduction_jobs)
+        print "Submit the reduction jobs after all partial merges have finished successfully."
+        write_arguments("arguments_reduction.txt", reduction_jobs.keys(), plan)
+    elif os.path.exists("arguments_reduction.txt"):
+        os.remove("arguments_reduction.txt")
 
 if __name__ == "__main__":
     main()
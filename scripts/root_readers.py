@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+
+# Classes of objects, for which TKey::IsFolder() is true, i.e. which are counted as pipelines
+FOLDER_CLASSES = ("TDirectory", "TTree", "TNtuple")
+
+def value_or_zero(value):
+    return 0 if value is None else value
+
+class MetadataReader(object):
+    """ Reads the metadata of Artus ntuples needed by the checks: the pipeline directories, the first bin of their cutflow histogram
+    and the entries of their ntuple. The backends only implement the access to single objects, such that all backends give identical results"""
+
+    def open_file(self, path):
+        """ Returns a handle of the opened file, None if the file is broken"""
+        raise NotImplementedError
+
+    def close_file(self, F):
+        pass
+
+    def list_pipelines(self, F):
+        raise NotImplementedError
+
+    def ntuple_entries(self, F, pipeline):
+        """ Entries of the ntuple of a pipeline, None if not available"""
+        raise NotImplementedError
+
+    def cutflow_first_bin(self, F, pipeline):
+        """ Content of the first bin of the cutflow histogram of a pipeline, None if not available"""
+        raise NotImplementedError
+
+    def read_ntuple_file(self, input_file):
+        """ Read the pipelines with the first bin of their cutflow histogram and the entries of their ntuple from a merged file.
+        Returns None, if the file is broken"""
+        F = self.open_file(input_file)
+        if F is None:
+            return None
+        file_result = {"pipelines" : sorted(self.list_pipelines(F)), "cutflow" : {}, "ntuple_tree_events" : {}}
+        for p in file_result["pipelines"]:
+            file_result["cutflow"][p] = value_or_zero(self.cutflow_first_bin(F, p))
+            file_result["ntuple_tree_events"][p] = value_or_zero(self.ntuple_entries(F, p))
+        self.close_file(F)
+        return file_result
+
+    def read_friend_file(self, friend):
+        """ Read the entries of the ntuple of all pipelines in a friend file"""
+        F = self.open_file(friend)
+        if F is None:
+            raise IOError("Could not open friend file %s" % friend)
+        friend_result = dict((p, value_or_zero(self.ntuple_entries(F, p))) for p in self.list_pipelines(F))
+        self.close_file(F)
+        return friend_result
+
+class PyROOTReader(MetadataReader):
+    """ Reads the metadata with PyROOT. Broken files are zombies or recovered files"""
+
+    def __init__(self):
+        import ROOT as R
+        R.gROOT.SetBatch()
+        R.gErrorIgnoreLevel = R.kError
+        self.R = R
+
+    def open_file(self, path):
+        F = self.R.TFile.Open(path, "read")
+        if not F or F.IsZombie() or F.TestBit(self.R.TFile.kRecovered):
+            if F:
+                F.Close()
+            return None
+        return F
+
+    def close_file(self, F):
+        F.Close()
+
+    def list_pipelines(self, F):
+        return [k.GetName() for k in F.GetListOfKeys() if k.IsFolder()]
+
+    def ntuple_entries(self, F, pipeline):
+        d = F.Get(pipeline)
+        ntuple = d.Get("ntuple") if d else None
+        if not ntuple:
+            return None
+        entries = ntuple.GetEntries()
+        ntuple.Delete()
+        return entries
+
+    def cutflow_first_bin(self, F, pipeline):
+        d = F.Get(pipeline)
+        cutflow = d.Get("cutFlowUnweighted") if d else None
+        if not cutflow:
+            return None
+        content = cutflow.GetBinContent(1)
+        cutflow.Delete()
+        return content
+
+def closed_properly(path):
+    """ Checks the header of a local ROOT file: the end of the file recorded in the header has to match the file size,
+    and the streamer info has to be written, as done by ROOT when closing a file. Otherwise, ROOT would try to recover the file"""
+    with open(path, "rb") as f:
+        header = f.read(64)
+    if len(header) < 64 or header[:4] != b"root":
+        return False
+    version, begin = struct.unpack(">ii", header[4:12])
+    # Files larger than 2 GB (version >= 1000000) have 64 bit pointers in the header
+    if version < 1000000:
+        end, = struct.unpack(">i", header[12:16])
+        seek_info, = struct.unpack(">i", header[37:41])
+    else:
+        end, = struct.unpack(">q", header[12:20])
+        seek_info, = struct.unpack(">q", header[45:53])
+    return end == os.path.getsize(path) and seek_info > begin
+
+def decode(name):
+    return name.decode("utf-8") if isinstance(name, bytes) else name
+
+class UprootReader(MetadataReader):
+    """ Reads the metadata with uproot, without any dependency on ROOT. Supports uproot 3 for Python 2 and uproot 4 and later for Python 3. Broken files are files,
+    which can't be opened, and local files, which were not closed properly (see closed_properly)"""
+
+    def __init__(self):
+        import uproot
+        self.uproot = uproot
+
+    def open_file(self, path):
+        if "://" not in path and not closed_properly(path):
+            return None
+        try:
+            return self.uproot.open(path)
+        except Exception:
+            return None
+
+    def close_file(self, F):
+        if hasattr(F, "close"):
+            F.close()
+
+    def classnames(self, directory):
+        """ Names of the objects in a directory without cycle number, with their class names"""
+        names = directory.classnames(recursive=False)
+        items = names.items() if isinstance(names, dict) else names
+        return dict((decode(name).split(";")[0], decode(classname)) for name, classname in items)
+
+    def list_pipelines(self, F):
+        return [name for name, classname in self.classnames(F).items() if classname.startswith(FOLDER_CLASSES)]
+
+    def get(self, F, pipeline, name, classprefix):
+        d = F[pipeline]
+        if not self.classnames(d).get(name, "").startswith(classprefix):
+            return None
+        return d[name]
+
+    def ntuple_entries(self, F, pipeline):
+        ntuple = self.get(F, pipeline, "ntuple", "TTree")
+        if ntuple is None:
+            return None
+        return int(ntuple.num_entries if hasattr(ntuple, "num_entries") else ntuple.numentries)
+
+    def cutflow_first_bin(self, F, pipeline):
+        cutflow = self.get(F, pipeline, "cutFlowUnweighted", "TH1")
+        if cutflow is None:
+            return None
+        values = cutflow.values() if callable(cutflow.values) else cutflow.values
+        return float(values[0])
+
+READERS = {
+    "pyroot" : PyROOTReader,
+    "uproot" : UprootReader,
+}
+
+def create_reader(name):
+    return READERS[name]()
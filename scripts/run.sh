@@ -20,8 +20,9 @@ then
     cd -
 fi
 
-echo "STEP 2: Checking CMSSW, hadd, xrd and gfal-copy"
+echo "STEP 2: Checking CMSSW, python, hadd, xrd and gfal-copy"
 echo $CMSSW_BASE
+which python
 which hadd
 which xrd
 which gfal-copy
@@ -30,9 +31,10 @@ echo "STEP 3: Starting merging script"
 NICK=${1}
 if [ -f "arguments.txt" ]
 then
-    NICK=$(head -n $((${1} + 1)) arguments.txt)
+    NICK=$(head -n $((${1} + 1)) arguments.txt | tail -n 1 | cut -d " " -f 1)
 fi
 
-tar -zxvf merging.tar.gz ${NICK}.sh
-time bash ./${NICK}.sh
-ls ${NICK}.root -lrth
+time python merge_job.py --bundle merging.zip ${NICK}
+STATUS=$?
+ls *.root -lrth
+exit ${STATUS}
@@ -2,26 +2,144 @@
 # -*- coding: utf-8 -*-
 
 import os
-import tarfile
+import sys
+import json
+import time
 import argparse
-from multiprocessing import Pool
+import threading
+import subprocess
 
-def execute_merging(sample):
-    tar = tarfile.open("merging.tar.gz", mode="r")
-    tar.extract("%s.sh"%sample)
-    os.system("bash %s.sh"%sample)
+def execute_merging(sample, log_directory):
+    """ Run a merging job from the job bundle, writing its output into a log file and its performance metrics into a .metrics.json file. Returns the exit code of the job"""
+    merge_job = os.path.join(os.path.dirname(os.path.abspath(__file__)), "merge_job.py")
+    metrics_file = os.path.join(log_directory, "%s.metrics.json"%sample)
+    with open(os.path.join(log_directory, "%s.log"%sample), "a") as log:
+        return subprocess.call([sys.executable, merge_job, "--bundle", "merging.zip", "--metrics-file", metrics_file, sample], stdout=log, stderr=subprocess.STDOUT)
+
+def format_duration(seconds):
+    return "%d:%02d:%02d" % (seconds / 3600, (seconds % 3600) / 60, seconds % 60)
+
+class LocalScheduler(object):
+    """ Runs merging jobs with a given number of parallel workers. Pending jobs are started largest first,
+    with at most 'max_per_endpoint' jobs reading from the same storage endpoint at the same time.
+    Failed jobs are retried after an exponentially increasing delay."""
+
+    def __init__(self, jobs, parallel, max_per_endpoint, retries, retry_delay, log_directory):
+        self.jobs = jobs
+        self.parallel = parallel
+        self.max_per_endpoint = max_per_endpoint
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.log_directory = log_directory
+        self.pending = sorted(jobs.keys(), key=lambda name: jobs[name]["size"], reverse=True)
+        self.attempts = dict((name, 0) for name in jobs)
+        self.not_before = dict((name, 0) for name in jobs)
+        self.running = {}
+        self.succeeded = []
+        self.failed = []
+        self.done_size = 0
+        self.total_size = sum(job["size"] for job in jobs.values())
+        self.condition = threading.Condition()
+
+    def next_job(self):
+        """ Largest pending job, which may be started now. Has to be called with the condition acquired"""
+        now = time.time()
+        for name in self.pending:
+            endpoint = self.jobs[name]["endpoint"]
+            if self.not_before[name] <= now and self.running.values().count(endpoint) < self.max_per_endpoint:
+                return name
+        return None
+
+    def worker(self):
+        while True:
+            with self.condition:
+                name = None
+                while self.pending or self.running:
+                    if not self.pending:
+                        self.condition.wait(1.0)
+                        continue
+                    name = self.next_job()
+                    if name:
+                        break
+                    self.condition.wait(1.0)
+                if not name:
+                    return
+                self.pending.remove(name)
+                self.running[name] = self.jobs[name]["endpoint"]
+                self.attempts[name] += 1
+            start = time.time()
+            exit_code = execute_merging(name, self.log_directory)
+            with self.condition:
+                self.running.pop(name)
+                if exit_code == 0:
+                    self.succeeded.append(name)
+                    self.done_size += self.jobs[name]["size"]
+                    status = "finished"
+                elif self.attempts[name] <= self.retries:
+                    delay = self.retry_delay * 2 ** (self.attempts[name] - 1)
+                    self.not_before[name] = time.time() + delay
+                    self.pending.append(name)
+                    self.pending.sort(key=lambda n: self.jobs[n]["size"], reverse=True)
+                    status = "failed with exit code %d, retrying in %d s" % (exit_code, delay)
+                else:
+                    self.failed.append(name)
+                    status = "failed with exit code %d, giving up" % exit_code
+                self.print_progress(name, status, time.time() - start)
+                self.condition.notify_all()
+
+    def print_progress(self, name, status, duration):
+        elapsed = time.time() - self.start_time
+        n_done = len(self.succeeded) + len(self.failed)
+        if self.done_size > 0:
+            eta = format_duration(elapsed / self.done_size * (self.total_size - self.done_size))
+        else:
+            eta = "unknown"
+        print "[%d/%d] %s %s after %s. Elapsed: %s, ETA: %s" % (n_done, len(self.jobs), name, status, format_duration(duration), format_duration(elapsed), eta)
+
+    def run(self):
+        self.start_time = time.time()
+        threads = [threading.Thread(target=self.worker) for i in range(self.parallel)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(1.0)
+        self.print_summary()
+        return len(self.failed) == 0
+
+    def print_summary(self):
+        elapsed = time.time() - self.start_time
+        print "Summary: %d of %d jobs succeeded, %d failed after %s" % (len(self.succeeded), len(self.jobs), len(self.failed), format_duration(elapsed))
+        print "\tMerged input size: %.2f GB, average throughput: %.1f MB/s" % (self.done_size / 1e9, self.done_size / 1e6 / max(elapsed, 1.0))
+        for name in self.failed:
+            print "\tFailed:",name,"(see %s)" % os.path.join(self.log_directory, "%s.log"%name)
 
 def parseargs():
-    parser = argparse.ArgumentParser(description='Script to run merging shell scripts (created by scripts/merge_outputs.py) locally in parallel.')
+    parser = argparse.ArgumentParser(description='Script to run merging jobs (created by scripts/merge_outputs.py) locally in parallel.')
     parser.add_argument('--parallel',type=int,help='Number of cores used for parallel processing. This option is required to be specified.',required=True)
+    parser.add_argument('--arguments-file',default='arguments.txt',help='File with the names of the merging jobs to be run, e.g. arguments_reduction.txt for the final reduction of partial merging jobs. Default: %(default)s')
+    parser.add_argument('--plan',default='merging_plan.json',help='Job plan written by scripts/merge_outputs.py, used to start the largest jobs first and to determine the storage endpoint of each job. Default: %(default)s')
+    parser.add_argument('--max-per-endpoint',type=int,default=None,help='Maximum number of jobs reading from the same storage endpoint at the same time. Default: value of --parallel')
+    parser.add_argument('--retries',type=int,default=2,help='Number of retries for failed jobs. Default: %(default)s')
+    parser.add_argument('--retry-delay',type=float,default=60.0,help='Delay in seconds before the first retry of a failed job, doubled for each further retry. Default: %(default)s')
+    parser.add_argument('--log-directory',default='merging_logs',help='Directory for the output of the merging jobs. Default: %(default)s')
     return parser.parse_args()
 
 def main():
     args = parseargs()
-    p = Pool(args.parallel)
-    argumentfile = open("arguments.txt","r")
-    sample_names = [name.strip() for name in argumentfile.read().strip().split("\n")]
-    p.map(execute_merging,sample_names)
+    argumentfile = open(args.arguments_file,"r")
+    # The first column holds the job name, the further columns the resources requested on the batch system
+    sample_names = [line.split()[0] for line in argumentfile.read().strip().split("\n") if line.strip()]
+    plan = json.load(open(args.plan,"r")) if os.path.exists(args.plan) else {}
+    jobs = {}
+    for name in sample_names:
+        jobs[name] = {"size" : plan.get(name, {}).get("size", 0), "endpoint" : plan.get(name, {}).get("endpoint", "unknown")}
+    if not os.path.exists(args.log_directory):
+        os.makedirs(args.log_directory)
+    scheduler = LocalScheduler(jobs, args.parallel, args.max_per_endpoint or args.parallel, args.retries, args.retry_delay, args.log_directory)
+    if not scheduler.run():
+        exit(1)
 
 if __name__ == "__main__":
     main()
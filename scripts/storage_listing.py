@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import json
+import stat
+import time
+from multiprocessing.pool import ThreadPool
+
+class StorageLister(object):
+    """ Lists directories on a xrootd server or on the local filesystem concurrently with a bounded pool of threads.
+    All threads share a single xrootd client. The listings can be cached in a .json file for 'cache_ttl' seconds.
+    Each entry of a listing is a dict with the keys "name", "is_dir", "size" and "mtime"."""
+
+    def __init__(self, xrootd_server=None, threads=10, cache_file=None, cache_ttl=0):
+        self.xrootd_server = xrootd_server
+        self.threads = max(threads, 1)
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.cache = {}
+        if self.xrootd_server:
+            from XRootD import client
+            self.filesystem = client.FileSystem(self.xrootd_server)
+        if self.cache_file and self.cache_ttl > 0 and os.path.exists(self.cache_file):
+            try:
+                self.cache = json.load(open(self.cache_file, "r"))
+            except ValueError:
+                print("[WARNING] Ignoring corrupted listing cache",self.cache_file)
+
+    def cache_key(self, directory):
+        return (self.xrootd_server or "") + "/" + directory.strip("/")
+
+    def list_xrootd(self, directory):
+        from XRootD.client.flags import DirListFlags, StatInfoFlags
+        status, listing = self.filesystem.dirlist(directory, DirListFlags.STAT)
+        if not status.ok:
+            print("[WARNING] Could not list %s via xrdfs: %s" % (directory, status.message))
+            return None
+        return [{"name" : entry.name.strip("/"), "is_dir" : bool(entry.statinfo.flags & StatInfoFlags.IS_DIR), "size" : entry.statinfo.size, "mtime" : entry.statinfo.modtime} for entry in listing]
+
+    def list_local(self, directory):
+        path = os.path.join("/", directory)
+        if not os.path.isdir(path):
+            return None
+        entries = []
+        for name in os.listdir(path):
+            if name.startswith("."):
+                continue
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            entries.append({"name" : name, "is_dir" : stat.S_ISDIR(st.st_mode), "size" : st.st_size, "mtime" : int(st.st_mtime)})
+        return entries
+
+    def list_directory(self, directory):
+        if self.xrootd_server:
+            return self.list_xrootd(directory)
+        return self.list_local(directory)
+
+    def list_directories(self, directories):
+        """ Returns a dict with the listing of each given directory. Directories, which can't be listed, get None as listing"""
+        now = time.time()
+        listings = {}
+        to_list = []
+        for d in set(directories):
+            cached = self.cache.get(self.cache_key(d))
+            if self.cache_ttl > 0 and cached and now - cached["time"] < self.cache_ttl:
+                listings[d] = cached["entries"]
+            else:
+                to_list.append(d)
+        if to_list:
+            pool = ThreadPool(min(self.threads, len(to_list)))
+            results = pool.map(self.list_directory, to_list)
+            pool.close()
+            pool.join()
+            for d, entries in zip(to_list, results):
+                listings[d] = entries
+                if entries is not None:
+                    self.cache[self.cache_key(d)] = {"time" : now, "entries" : entries}
+            self.save_cache()
+        return listings
+
+    def save_cache(self):
+        if not self.cache_file or self.cache_ttl <= 0:
+            return
+        # Other listers may have updated the same cache file in the meantime
+        if os.path.exists(self.cache_file):
+            try:
+                stored = json.load(open(self.cache_file, "r"))
+            except ValueError:
+                stored = {}
+            for key, cached in stored.items():
+                if key not in self.cache or self.cache[key]["time"] < cached["time"]:
+                    self.cache[key] = cached
+        now = time.time()
+        for key in [k for k in self.cache if now - self.cache[k]["time"] >= self.cache_ttl]:
+            self.cache.pop(key)
+        json.dump(self.cache, open(self.cache_file, "w"))